@@ -0,0 +1,134 @@
+"""
+Semantic cache of chat answers, looked up by the cosine similarity of the question
+embedding. Entries are scoped (e.g. by index name and generation parameters),
+expire after a TTL and are evicted least recently used first.
+"""
+
+import hashlib
+import json
+import threading
+import time
+import numpy as np
+
+
+def get_scope(**params):
+    """
+    Returns a stable key for the parameters an answer depends on.
+    """
+    return hashlib.sha1(
+        json.dumps(params, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+class SemanticAnswerCache:
+    """
+    In-memory cache holding the question embeddings in a preallocated matrix.
+    A lookup returns the answer of the most similar cached question of the same
+    scope, if its similarity is at least threshold.
+    """
+
+    def __init__(self, max_entries=1000, ttl=3600, threshold=0.95):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.valid = np.zeros(max_entries, dtype=bool)
+        self.created = np.zeros(max_entries)
+        self.last_used = np.zeros(max_entries)
+        self.scopes = [None] * max_entries
+        self.index_names = [None] * max_entries
+        self.answers = [None] * max_entries
+        self.index_versions = {}
+        self.last_index_check = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalise(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def expire(self, now):
+        self.valid &= now - self.created < self.ttl
+
+    def get(self, embedding, scope):
+        """
+        Returns (answer, similarity) of the best match, or (None, similarity).
+        """
+        now = time.time()
+        with self.lock:
+            self.expire(now)
+            if self.vectors is None or not self.valid.any():
+                self.misses += 1
+                return None, 0.0
+            mask = self.valid & np.fromiter(
+                (entry_scope == scope for entry_scope in self.scopes),
+                dtype=bool,
+                count=self.max_entries,
+            )
+            if not mask.any():
+                self.misses += 1
+                return None, 0.0
+            similarities = np.where(
+                mask, self.vectors @ self.normalise(embedding), -np.inf
+            )
+            slot = int(np.argmax(similarities))
+            similarity = float(similarities[slot])
+            if similarity < self.threshold:
+                self.misses += 1
+                return None, similarity
+            self.last_used[slot] = now
+            self.hits += 1
+            return self.answers[slot], similarity
+
+    def put(self, embedding, scope, answer, index_name=None):
+        vector = self.normalise(embedding)
+        now = time.time()
+        with self.lock:
+            if self.vectors is None:
+                self.vectors = np.zeros(
+                    (self.max_entries, len(vector)), dtype=np.float32
+                )
+            self.expire(now)
+            free = np.flatnonzero(~self.valid)
+            if len(free):
+                slot = int(free[0])
+            else:
+                # Evict the least recently used entry
+                slot = int(np.argmin(self.last_used))
+            self.vectors[slot] = vector
+            self.valid[slot] = True
+            self.created[slot] = now
+            self.last_used[slot] = now
+            self.scopes[slot] = scope
+            self.index_names[slot] = index_name
+            self.answers[slot] = answer
+
+    def invalidate(self, index_name=None):
+        """
+        Drops the entries answered from index_name, or all entries.
+        """
+        with self.lock:
+            for slot in range(self.max_entries):
+                if index_name is None or self.index_names[slot] == index_name:
+                    self.valid[slot] = False
+                    self.answers[slot] = None
+
+    def update_index_version(self, index_name, version):
+        """
+        Invalidates the entries of index_name when its version changed, e.g. after
+        the index was rebuilt or re-indexed. Returns True if it did.
+        """
+        self.last_index_check = time.time()
+        previous = self.index_versions.get(index_name)
+        self.index_versions[index_name] = version
+        if previous is not None and previous != version:
+            self.invalidate(index_name)
+            return True
+        return False
+
+    def __len__(self):
+        with self.lock:
+            self.expire(time.time())
+            return int(self.valid.sum())
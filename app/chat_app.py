@@ -5,6 +5,17 @@ import openai
 import time
 import requests
 import json
+import hashlib
+import logging
+from retrieval import AzureSearchClient, HybridRetriever, format_context
+from answer_cache import SemanticAnswerCache, get_scope
+from chat_history import (
+    MESSAGE_OVERHEAD_TOKENS,
+    REPLY_OVERHEAD_TOKENS,
+    ChatHistoryManager,
+    get_token_counter,
+)
+from metrics import MetricsRegistry, RequestTrace
 
 load_dotenv()
 
@@ -25,6 +36,12 @@ search_key = os.getenv("AI_SEARCH_KEY")
 # Add your Azure AI Search admin key here
 search_index_name = os.getenv("AI_SEARCH_INDEX")
 # Add your Azure AI Search index name here
+# The indexer pipeline names the semantic configuration of the vector index
+# deterministically, as "semantic-config-<sha1 of index name>" truncated to 28 chars
+index_name_hash = hashlib.sha1((search_index_name or "").encode("utf-8")).hexdigest()
+semantic_config = os.getenv(
+    "AI_SEARCH_SEMANTIC_CONFIG", f"semantic-config-{index_name_hash}"[:28]
+)
 
 # Azure Embedding model endpoint
 embedding_endpoint = os.getenv("VECTOR_EMBEDDING_URI")
@@ -32,6 +49,29 @@ embedding_key = os.getenv("VECTOR_EMBEDDING_API_KEY")
 
 
 topN = 5
+# Latency budget, in seconds, of client side retrieval ("clientHybrid" query type)
+retrieval_timeout = float(os.getenv("RETRIEVAL_TIMEOUT", "1.5"))
+# Semantic cache of first-turn answers, keyed by the question embedding. Opt in,
+# as a similar past question then receives the stored answer
+answer_cache_enabled = os.getenv("ANSWER_CACHE_ENABLED", "False") == "True"
+answer_cache_threshold = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+answer_cache_ttl = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+answer_cache_max_entries = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+# Seconds between checks of whether the index changed, which invalidates the cache
+answer_cache_index_check = int(os.getenv("ANSWER_CACHE_INDEX_CHECK", "60"))
+# Token budget of the chat history sent with each question, and how older turns
+# are compacted: "relevance" (keep the most relevant), "summary" or "off"
+history_token_budget = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+history_compaction = os.getenv("HISTORY_COMPACTION", "relevance")
+history_summary_tokens = 250
+# Render answers token by token as they are generated
+stream_responses = os.getenv("STREAM_RESPONSES", "True") == "True"
+# Per-stage latency metrics: requests kept for the percentiles, and where they are
+# exported (JSON lines of each request, Prometheus text file, /metrics port; 0 is off)
+metrics_window = int(os.getenv("METRICS_WINDOW", "1000"))
+metrics_file = os.getenv("METRICS_FILE")
+metrics_prometheus_file = os.getenv("METRICS_PROMETHEUS_FILE")
+metrics_port = int(os.getenv("METRICS_PORT", "0"))
 strictness = 3
 enforce_inscope = True
 SYSTEM_PROMPT = """
@@ -90,8 +130,15 @@ def get_chat_response(
     top_p: float,
     max_tokens: int,
     queryType: str,
+    metadata: dict,
+    stream: bool = True,
 ):
+    """
+    Generator yielding the answer text as it is generated (in one piece if stream
+    is False). Usage and citations are added to metadata once the answer is complete.
+    """
     response = openai.ChatCompletion.create(
+        stream=stream,
         temperature=temperature,
         top_p=top_p,
         max_tokens=max_tokens,
@@ -106,7 +153,7 @@ def get_chat_response(
                     "indexName": search_index_name,
                     "topNDocuments": topN,
                     "inScope": enforce_inscope,
-                    "semanticConfiguration": "semantic-config-a0859498-994",
+                    "semanticConfiguration": semantic_config,
                     "roleInformation": role_information,
                     "strictness": strictness,
                     "queryType": queryType,
@@ -124,9 +171,306 @@ def get_chat_response(
             }
         ],
     )
-    bot_response = response.choices[0]["message"]["content"]
-    usage_data = json.dumps(response["usage"]).strip("{").strip("}")
-    return bot_response, usage_data
+    if not stream:
+        message = response.choices[0]["message"]
+        for context_message in message.get("context", {}).get("messages", []):
+            read_tool_message(context_message, metadata)
+        metadata["usage"] = dict(response["usage"])
+        yield message["content"]
+        return
+    pieces = []
+    for chunk in response:
+        for choice in chunk.get("choices") or []:
+            # The extensions endpoint nests the deltas in messages
+            deltas = [m.get("delta", {}) for m in choice.get("messages") or []]
+            for delta in deltas or [choice.get("delta", {})]:
+                if delta.get("role") == "tool":
+                    read_tool_message(delta, metadata)
+                elif delta.get("content"):
+                    pieces.append(delta["content"])
+                    yield delta["content"]
+        if chunk.get("usage"):
+            metadata["usage"] = dict(chunk["usage"])
+    # The prompt estimate misses the documents retrieved by the extension
+    metadata.setdefault("usage", estimate_usage(chat_history, "".join(pieces)))
+
+
+@st.cache_resource
+def get_count_tokens():
+    return get_token_counter()
+
+
+def estimate_usage(messages: list, completion: str) -> dict:
+    """
+    Estimates the token usage of a streamed answer, which Azure OpenAI streams do
+    not report.
+    """
+    count_tokens = get_count_tokens()
+    prompt_tokens = REPLY_OVERHEAD_TOKENS + sum(
+        count_tokens(message["content"] or "") + MESSAGE_OVERHEAD_TOKENS
+        for message in messages
+    )
+    completion_tokens = count_tokens(completion)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "estimated": True,
+    }
+
+
+def read_tool_message(message: dict, metadata: dict):
+    """
+    Collects the citations of the "on your data" tool message into metadata.
+    """
+    try:
+        citations = json.loads(message.get("content") or "{}").get("citations", [])
+    except ValueError:
+        return
+    metadata.setdefault("citations", []).extend(
+        citation.get("filepath") or citation.get("url") or citation.get("title")
+        for citation in citations
+    )
+
+
+def iter_sse_events(response):
+    """
+    Yields the JSON events of a server-sent events chat completions stream.
+    """
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            return
+        yield json.loads(data)
+
+
+def summarize_history(previous_summary: str, messages: list) -> str:
+    """
+    Folds messages into the rolling summary of the conversation.
+    """
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    response = requests.post(
+        f"{openai.api_base}/openai/deployments/{deployment_id}/chat/completions?api-version={openai.api_version}",
+        headers={"Content-Type": "application/json", "api-key": openai.api_key},
+        json={
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "Update the summary of a customer service conversation "
+                    "with the new messages. Keep the customer's details, questions "
+                    "and the answers given. Be brief.",
+                },
+                {
+                    "role": "user",
+                    "content": f"Summary:\n{previous_summary}\n\nNew messages:\n{transcript}",
+                },
+            ],
+            "temperature": 0,
+            "max_tokens": history_summary_tokens,
+        },
+        timeout=60,
+    )
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"]
+
+
+def get_history_manager():
+    if "history_manager" not in st.session_state:
+        st.session_state.history_manager = ChatHistoryManager(
+            budget=history_token_budget,
+            mode=history_compaction,
+            summarize=summarize_history,
+            summary_tokens=history_summary_tokens,
+        )
+    return st.session_state.history_manager
+
+
+# Shared by all sessions, as Streamlit re-runs this script on every interaction
+@st.cache_resource
+def get_retriever():
+    return HybridRetriever(
+        AzureSearchClient(search_endpoint, search_key, search_index_name),
+        top=topN,
+        timeout=retrieval_timeout,
+    )
+
+
+@st.cache_resource
+def get_answer_cache():
+    return SemanticAnswerCache(
+        max_entries=answer_cache_max_entries,
+        ttl=answer_cache_ttl,
+        threshold=answer_cache_threshold,
+    )
+
+
+@st.cache_resource
+def get_metrics():
+    registry = MetricsRegistry(window=metrics_window)
+    if metrics_port:
+        registry.start_http_server(metrics_port)
+    return registry
+
+
+def get_embedding(text: str):
+    response = requests.post(
+        embedding_endpoint,
+        headers={"Content-Type": "application/json", "api-key": embedding_key},
+        json={"input": text},
+        timeout=10,
+    )
+    response.raise_for_status()
+    return response.json()["data"][0]["embedding"]
+
+
+def get_index_version():
+    """
+    Returns a fingerprint of the index definition and content, which changes when
+    the index is rebuilt or re-indexed.
+    """
+    base_url = f"{search_endpoint.rstrip('/')}/indexes('{search_index_name}')"
+    params = {"api-version": "2023-10-01-Preview"}
+    headers = {"api-key": search_key}
+    definition = requests.get(base_url, headers=headers, params=params, timeout=5)
+    stats = requests.get(f"{base_url}/stats", headers=headers, params=params, timeout=5)
+    definition.raise_for_status()
+    stats.raise_for_status()
+    return get_scope(etag=definition.json().get("@odata.etag"), stats=stats.json())
+
+
+def get_cached_chat_response(
+    chat_history: list,
+    metadata: dict,
+    stream: bool = True,
+    use_cache: bool = True,
+    **params,
+):
+    """
+    Generator answering first-turn questions from the semantic cache when a similar
+    question was answered with the same parameters, else streaming the model's
+    answer and caching it. Follow-up questions depend on the conversation, so they
+    are not cached. use_cache: False for follow-up questions whose earlier turns
+    were compacted out of chat_history.
+    """
+    if params["queryType"] == "clientHybrid":
+        get_response = get_client_retrieval_response
+        model_params = {k: v for k, v in params.items() if k != "queryType"}
+    else:
+        get_response, model_params = get_chat_response, dict(params)
+    model_params.update(metadata=metadata, stream=stream)
+    if (
+        not answer_cache_enabled
+        or not use_cache
+        or any(message["role"] == "assistant" for message in chat_history)
+    ):
+        yield from get_response(chat_history=chat_history, **model_params)
+        return
+
+    # The cache is an optimisation: when it fails, the question is answered uncached
+    cache = get_answer_cache()
+    trace = metadata.setdefault("trace", RequestTrace())
+    if time.time() - cache.last_index_check > answer_cache_index_check:
+        try:
+            with trace.span("index_version_check"):
+                index_version = get_index_version()
+            cache.update_index_version(search_index_name, index_version)
+        except Exception as e:
+            cache.last_index_check = time.time()
+            logging.warning(f"Index version check FAILED. Error: {e}")
+    scope = get_scope(
+        index_name=search_index_name,
+        deployment_id=deployment_id,
+        system_prompt=SYSTEM_PROMPT,
+        **params,
+    )
+    try:
+        with trace.span("embedding"):
+            embedding = get_embedding(chat_history[-1]["content"])
+        with trace.span("cache_lookup"):
+            answer, similarity = cache.get(embedding, scope)
+    except Exception as e:
+        logging.warning(f"Answer cache lookup FAILED, answering uncached. Error: {e}")
+        yield from get_response(chat_history=chat_history, **model_params)
+        return
+    if answer is not None:
+        metadata["usage"] = {"cache": "hit", "similarity": round(similarity, 3)}
+        yield answer
+        return
+    pieces = []
+    for piece in get_response(chat_history=chat_history, **model_params):
+        pieces.append(piece)
+        yield piece
+    try:
+        cache.put(embedding, scope, "".join(pieces), index_name=search_index_name)
+    except Exception as e:
+        logging.warning(f"Answer cache store FAILED. Error: {e}")
+
+
+def get_client_retrieval_response(
+    chat_history: list,
+    temperature: float,
+    top_p: float,
+    max_tokens: int,
+    metadata: dict,
+    stream: bool = True,
+):
+    """
+    Retrieves the context with HybridRetriever and sends it with the chat history
+    to the plain chat completions endpoint, instead of the "on your data" extension.
+    Generator yielding the answer text, like get_chat_response.
+    """
+    trace = metadata.setdefault("trace", RequestTrace())
+    retriever = get_retriever()
+    with trace.span("retrieval"):
+        documents, timings = retriever.retrieve(chat_history[-1]["content"])
+    for name in ("keyword", "vector"):
+        if f"{name}_ms" in timings:
+            trace.record(f"retrieval.{name}", timings[f"{name}_ms"] / 1000)
+    with trace.span("prompt_assembly"):
+        messages = [
+            {
+                "role": "system",
+                "content": f"{SYSTEM_PROMPT}\nSources:\n{format_context(documents)}",
+            },
+            *[message for message in chat_history if message["role"] != "system"],
+        ]
+    # Sent without openai.requestssession, which routes to the extensions endpoint
+    response = requests.post(
+        f"{openai.api_base}/openai/deployments/{deployment_id}/chat/completions?api-version={openai.api_version}",
+        headers={"Content-Type": "application/json", "api-key": openai.api_key},
+        json={
+            "messages": messages,
+            "temperature": temperature,
+            "top_p": top_p,
+            "max_tokens": max_tokens,
+            "stream": stream,
+        },
+        timeout=120,
+        stream=stream,
+    )
+    response.raise_for_status()
+    metadata["citations"] = [document.get("parent_key") for document in documents]
+    timings = {name: round(value) for name, value in timings.items()}
+    if not stream:
+        response = response.json()
+        metadata["usage"] = {**response["usage"], **timings}
+        yield response["choices"][0]["message"]["content"]
+        return
+    pieces = []
+    with response:
+        for chunk in iter_sse_events(response):
+            for choice in chunk.get("choices") or []:
+                content = choice.get("delta", {}).get("content")
+                if content:
+                    pieces.append(content)
+                    yield content
+            if chunk.get("usage"):
+                metadata["usage"] = {**chunk["usage"], **timings}
+    metadata.setdefault(
+        "usage", {**estimate_usage(messages, "".join(pieces)), **timings}
+    )
 
 
 def add_sliders(variable, display_name, min_value, max_value, default_value):
@@ -159,10 +503,20 @@ def main():
     add_sliders("temperature", "Temperature", 0.0, 1.0, 0.7)
     add_sliders("top_p", "Top P", 0.0, 1.0, 0.95)
     add_sliders("max_tokens", "Max Tokens", 1, 5000, 500)
+    st.session_state.stream = st.sidebar.checkbox(
+        "Stream response", value=st.session_state.get("stream", stream_responses)
+    )
     add_selectbox(
         "queryType",
         "Query Type",
-        ["vector", "simple", "semantic", "vectorSimpleHybrid", "vectorSemanticHybrid"],
+        [
+            "vector",
+            "simple",
+            "semantic",
+            "vectorSimpleHybrid",
+            "vectorSemanticHybrid",
+            "clientHybrid",
+        ],
     )
     # Display chat messages from history on app rerun
     if "messages" not in st.session_state:
@@ -185,24 +539,78 @@ def main():
             full_response = ""
         message_placeholder.markdown("Thinking...")
         start_time = time.time()
-        full_response, usage_data = get_chat_response(
-            chat_history=[
-                {"role": m["role"], "content": m["content"]}
-                for m in st.session_state.messages
-            ],
+        first_token_time = None
+        chat_history = [
+            {"role": m["role"], "content": m["content"]}
+            for m in st.session_state.messages
+        ]
+        trace = RequestTrace(get_metrics())
+        metadata = {"trace": trace}
+        # Decided before compaction, which may evict all the earlier turns
+        first_turn = not any(
+            message["role"] == "assistant" for message in st.session_state.messages
+        )
+        if history_compaction != "off":
+            with trace.span("prompt_assembly"):
+                history_manager = get_history_manager()
+                chat_history = history_manager.compact(chat_history)
+            metadata["history"] = history_manager.last_report
+        # Generation is the time in the response generator not taken by its spans
+        traced_time = trace.traced_seconds()
+        generation_start_time = time.perf_counter()
+        for piece in get_cached_chat_response(
+            chat_history=chat_history,
+            metadata=metadata,
+            stream=st.session_state.stream,
+            use_cache=first_turn,
             temperature=st.session_state.temperature,
             top_p=st.session_state.top_p,
             max_tokens=st.session_state.max_tokens,
             queryType=st.session_state.queryType,
+        ):
+            if first_token_time is None:
+                first_token_time = time.time()
+            full_response += piece
+            with trace.span("rendering"):
+                message_placeholder.markdown(full_response + "▌")
+        trace.record(
+            "generation",
+            time.perf_counter()
+            - generation_start_time
+            - (trace.traced_seconds() - traced_time),
         )
         end_time = time.time()
         execution_time = end_time - start_time
-        message_placeholder.markdown(full_response)
+        first_token_latency = (first_token_time or end_time) - start_time
+        with trace.span("rendering"):
+            message_placeholder.markdown(full_response)
+        trace.record("first_token", first_token_latency)
+        trace.record("total", execution_time)
+        trace.add_tokens(metadata.get("usage", {}))
+        trace.finish()
+        try:
+            if metrics_file:
+                trace.write_jsonl(metrics_file)
+            if metrics_prometheus_file:
+                trace.registry.write_prometheus_file(metrics_prometheus_file)
+        except OSError as e:
+            logging.error(f"Metrics export FAILED. Error: {e}")
         with st.chat_message("ai"):
             usage_placeholder = st.empty()
 
+        usage_data = json.dumps(metadata.get("usage", {})).strip("{").strip("}")
+        citations = len(metadata.get("citations", []))
+        stages = ", ".join(
+            f"{stage} {seconds * 1000:.0f}ms"
+            for stage, seconds in trace.durations.items()
+            if stage not in ("first_token", "total")
+        )
+        if "history" in metadata:
+            usage_data += (
+                f', "history_saved_tokens": {metadata["history"]["saved_tokens"]}'
+            )
         usage_placeholder.markdown(
-            f'<sub><span style="color: lightgrey;font-size: 14px;">Response generated in {execution_time:.2f} seconds. {usage_data}</sub>',
+            f'<sub><span style="color: lightgrey;font-size: 14px;">Response generated in {execution_time:.2f} seconds, first token after {first_token_latency:.2f} seconds. {citations} citations. {stages}. {usage_data}</sub>',
             unsafe_allow_html=True,
         )
         st.session_state.messages.append(
@@ -0,0 +1,160 @@
+"""
+Keeps the chat history sent to the model within a token budget.
+The system prompt and the most recent turns are kept; older turns are folded into
+a rolling summary, or dropped except for those most relevant to the new question.
+"""
+
+import logging
+import math
+import re
+
+WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+# Words compared to rank old turns by relevance, ignoring the shortest ones
+RELEVANCE_WORD_PATTERN = re.compile(r"\w{3,}")
+# Tokens added by the chat format around each message, and to prime the reply
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+
+
+def get_token_counter(encoding_name="cl100k_base"):
+    """
+    Returns a function counting the tokens of a text. Mirrors
+    embedding_pipeline.get_token_counter, as the app is deployed without src/.
+    Uses tiktoken, falling back to a word based estimate if the encoding cannot be loaded.
+    """
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(encoding_name)
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        logging.warning(f"tiktoken unavailable, estimating token counts. Error: {e}")
+        return lambda text: math.ceil(len(WORD_PATTERN.findall(text)) * 4 / 3)
+
+
+def split_turns(messages):
+    """
+    Groups messages into turns, each starting with a user message.
+    """
+    turns = []
+    for message in messages:
+        if message["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+class ChatHistoryManager:
+    """
+    Compacts the chat history of one conversation before each model call.
+    mode: "summary" folds evicted turns into a rolling summary with summarize,
+    "relevance" keeps the evicted turns sharing the most words with the question.
+    summarize(previous_summary, messages) returns the new summary text, of at most
+    summary_tokens tokens.
+    """
+
+    def __init__(
+        self,
+        budget=3000,
+        mode="relevance",
+        summarize=None,
+        count_tokens=None,
+        summary_tokens=250,
+    ):
+        self.budget = budget
+        self.mode = mode
+        self.summary_tokens = summary_tokens
+        self.summarize = summarize
+        self.count_tokens = count_tokens or get_token_counter()
+        self.summary = ""
+        self.summarized = 0
+        self.last_report = {}
+
+    def message_tokens(self, message):
+        return self.count_tokens(message["content"] or "") + MESSAGE_OVERHEAD_TOKENS
+
+    def messages_tokens(self, messages):
+        return sum(self.message_tokens(message) for message in messages) + (
+            REPLY_OVERHEAD_TOKENS
+        )
+
+    def summary_message(self):
+        return {
+            "role": "system",
+            "content": f"Summary of the earlier conversation:\n{self.summary}",
+        }
+
+    def select_relevant(self, turns, query, budget):
+        """
+        Returns the turns sharing the most words with query that fit in budget,
+        in their original order.
+        """
+        query_words = set(RELEVANCE_WORD_PATTERN.findall(query.lower()))
+        scored = []
+        for i, turn in enumerate(turns):
+            words = set(
+                RELEVANCE_WORD_PATTERN.findall(
+                    " ".join(m["content"] or "" for m in turn).lower()
+                )
+            )
+            overlap = len(query_words & words) / max(len(query_words), 1)
+            if overlap > 0:
+                scored.append((overlap, i))
+        selected = []
+        for _, i in sorted(scored, reverse=True):
+            tokens = sum(self.message_tokens(message) for message in turns[i])
+            if tokens <= budget:
+                selected.append(i)
+                budget -= tokens
+        return [turns[i] for i in sorted(selected)]
+
+    def compact(self, messages):
+        """
+        Returns the messages to send. The report of the compaction (original,
+        sent and saved tokens, kept and folded turns) is kept in last_report.
+        """
+        system = [message for message in messages if message["role"] == "system"]
+        turns = split_turns([m for m in messages if m["role"] != "system"])
+        original_tokens = self.messages_tokens(messages)
+        budget = self.budget - self.messages_tokens(system)
+        if self.mode == "summary":
+            budget -= self.summary_tokens + MESSAGE_OVERHEAD_TOKENS
+
+        # Keep the most recent turns that fit, always including the new question
+        recent = []
+        for turn in reversed(turns):
+            tokens = sum(self.message_tokens(message) for message in turn)
+            if recent and tokens > budget:
+                break
+            recent.insert(0, turn)
+            budget -= tokens
+        evicted = turns[: len(turns) - len(recent)]
+
+        older = []
+        if evicted and self.mode == "summary" and self.summarize is not None:
+            # Fold only the turns evicted since the last summary
+            new_messages = [m for turn in evicted for m in turn][self.summarized :]
+            if new_messages:
+                try:
+                    self.summary = self.summarize(self.summary, new_messages)
+                    self.summarized += len(new_messages)
+                except Exception as e:
+                    # The turns are dropped this time and folded on the next call
+                    logging.error(f"Summarizing the chat history FAILED. Error: {e}")
+        elif evicted and self.mode == "relevance":
+            query = recent[-1][0]["content"] if recent else ""
+            older = self.select_relevant(evicted, query or "", budget)
+
+        compacted = list(system)
+        if self.mode == "summary" and self.summary:
+            compacted.append(self.summary_message())
+        compacted.extend(m for turn in older + recent for m in turn)
+        compacted_tokens = self.messages_tokens(compacted)
+        self.last_report = {
+            "history_tokens": original_tokens,
+            "sent_tokens": compacted_tokens,
+            "saved_tokens": max(0, original_tokens - compacted_tokens),
+            "kept_turns": len(older) + len(recent),
+            "evicted_turns": len(evicted) - len(older),
+        }
+        return compacted
@@ -0,0 +1,338 @@
+"""
+In-process retrieval over the chunks of the vector index, without a search service.
+Keyword queries are scored with BM25 over a compact inverted index, vector queries
+by brute force over a memory mapped NumPy matrix.
+
+Usage:
+    python app/local_search.py build SOURCE INDEX_DIR
+    python app/local_search.py query INDEX_DIR "search text"
+
+SOURCE is a .jsonl file of chunk documents (id, chunk, parent_key and optionally
+embedding), or a directory of crawled .txt blobs, which are split into chunks.
+"""
+
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+")
+PARAGRAPH_SEPARATOR = re.compile(r"\n\s*\n")
+EQ_FILTER = re.compile(r"^\s*(\w+)\s+eq\s+'((?:[^']|'')*)'\s*$")
+SEARCH_IN_FILTER = re.compile(
+    r"^\s*search\.in\(\s*(\w+)\s*,\s*'((?:[^']|'')*)'\s*(?:,\s*'([^']*)'\s*)?\)\s*$"
+)
+DOCUMENT_FIELDS = ("id", "chunk", "parent_key")
+# Constant of the reciprocal rank fusion of hybrid queries, as used by the service
+RRF_K = 60
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def iter_text_chunks(directory, max_words=300):
+    """
+    Yields chunk documents for the .txt files of directory, split on paragraphs.
+    """
+    for root, _, file_names in os.walk(directory):
+        for file_name in sorted(file_names):
+            if not file_name.endswith(".txt"):
+                continue
+            path = os.path.join(root, file_name)
+            parent_key = os.path.relpath(path, directory).replace(os.sep, "/")
+            with open(path, encoding="utf-8") as f:
+                paragraphs = PARAGRAPH_SEPARATOR.split(f.read())
+            chunk, words, i = [], 0, 0
+            for paragraph in paragraphs + [None]:
+                paragraph_words = len(paragraph.split()) if paragraph else 0
+                if chunk and (paragraph is None or words + paragraph_words > max_words):
+                    yield {
+                        "id": f"{parent_key}_{i}",
+                        "chunk": "\n\n".join(chunk),
+                        "parent_key": parent_key,
+                    }
+                    chunk, words, i = [], 0, i + 1
+                if paragraph and paragraph.strip():
+                    chunk.append(paragraph.strip())
+                    words += paragraph_words
+
+
+def parse_filter(filter_expression):
+    """
+    Parses the OData filters used against the vector index:
+    "field eq 'value'" and "search.in(field, 'a|b', '|')".
+    Returns (field, set of values).
+    """
+    match = EQ_FILTER.match(filter_expression)
+    if match:
+        return match.group(1), {match.group(2).replace("''", "'")}
+    match = SEARCH_IN_FILTER.match(filter_expression)
+    if match:
+        field, values, separator = match.groups()
+        values = values.replace("''", "'")
+        if separator:
+            return field, set(values.split(separator))
+        return field, set(re.split(r"[ ,]+", values.strip()))
+    raise ValueError(f"Unsupported filter: {filter_expression}")
+
+
+class LocalSearchIndex:
+    """
+    Local stand-in for the vector index: same fields (id, chunk, parent_key,
+    embedding) and a subset of the docs/search request and response format.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents = []
+        self.terms = {}
+        self.postings_docs = np.empty(0, dtype=np.int32)
+        self.postings_tfs = np.empty(0, dtype=np.float32)
+        self.doc_lengths = np.empty(0, dtype=np.float32)
+        self.embeddings = None
+        self.field_values = {}
+
+    def build(self, documents):
+        """
+        Indexes documents (dicts with id, chunk, parent_key and optionally embedding).
+        """
+        postings = defaultdict(list)
+        doc_lengths, embeddings = [], []
+        self.documents = []
+        self.field_values = {}
+        for doc_id, document in enumerate(documents):
+            self.documents.append(
+                {field: document.get(field) for field in DOCUMENT_FIELDS}
+            )
+            tokens = tokenize(document.get("chunk") or "")
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings[term].append((doc_id, tf))
+            if document.get("embedding") is not None:
+                embeddings.append(document["embedding"])
+        # Store all posting lists in two flat arrays, addressed by term offsets
+        offset, docs, tfs = 0, [], []
+        self.terms = {}
+        for term, term_postings in postings.items():
+            self.terms[term] = (offset, len(term_postings))
+            offset += len(term_postings)
+            docs.extend(doc_id for doc_id, _ in term_postings)
+            tfs.extend(tf for _, tf in term_postings)
+        self.postings_docs = np.asarray(docs, dtype=np.int32)
+        self.postings_tfs = np.asarray(tfs, dtype=np.float32)
+        self.doc_lengths = np.asarray(doc_lengths, dtype=np.float32)
+        if embeddings:
+            if len(embeddings) != len(self.documents):
+                raise ValueError(
+                    "Either all or none of the documents need an embedding"
+                )
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            self.embeddings = embeddings / np.maximum(norms, 1e-12)
+        else:
+            self.embeddings = None
+        return self
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "index.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "k1": self.k1,
+                    "b": self.b,
+                    "documents": self.documents,
+                    "terms": self.terms,
+                },
+                f,
+            )
+        np.save(os.path.join(directory, "postings_docs.npy"), self.postings_docs)
+        np.save(os.path.join(directory, "postings_tfs.npy"), self.postings_tfs)
+        np.save(os.path.join(directory, "doc_lengths.npy"), self.doc_lengths)
+        if self.embeddings is not None:
+            np.save(os.path.join(directory, "embeddings.npy"), self.embeddings)
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Loads a saved index. The arrays are memory mapped, not read into memory.
+        """
+        with open(os.path.join(directory, "index.json"), encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(k1=data["k1"], b=data["b"])
+        index.documents = data["documents"]
+        index.terms = {term: tuple(value) for term, value in data["terms"].items()}
+        index.postings_docs = np.load(
+            os.path.join(directory, "postings_docs.npy"), mmap_mode="r"
+        )
+        index.postings_tfs = np.load(
+            os.path.join(directory, "postings_tfs.npy"), mmap_mode="r"
+        )
+        index.doc_lengths = np.load(os.path.join(directory, "doc_lengths.npy"))
+        embeddings_path = os.path.join(directory, "embeddings.npy")
+        if os.path.exists(embeddings_path):
+            index.embeddings = np.load(embeddings_path, mmap_mode="r")
+        return index
+
+    def get_filter_mask(self, filter_expression):
+        if not filter_expression:
+            return None
+        field, values = parse_filter(filter_expression)
+        if field not in DOCUMENT_FIELDS:
+            raise ValueError(f"Field {field} is not filterable")
+        if field not in self.field_values:
+            # Built on first use: value -> doc ids
+            field_values = defaultdict(list)
+            for doc_id, document in enumerate(self.documents):
+                field_values[document[field]].append(doc_id)
+            self.field_values[field] = field_values
+        mask = np.zeros(len(self.documents), dtype=bool)
+        for value in values:
+            mask[self.field_values[field].get(value, [])] = True
+        return mask
+
+    @staticmethod
+    def top_k(scores, k, mask=None):
+        """
+        Returns (doc_ids, scores) of the k best positive scores.
+        """
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        k = min(k, len(scores))
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[np.isfinite(scores[top])]
+        return top, scores[top]
+
+    def bm25_scores(self, search_text):
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        if not len(self.documents):
+            return scores
+        average_length = max(float(self.doc_lengths.mean()), 1.0)
+        for term in set(tokenize(search_text)):
+            if term not in self.terms:
+                continue
+            offset, length = self.terms[term]
+            docs = self.postings_docs[offset : offset + length]
+            tfs = self.postings_tfs[offset : offset + length]
+            idf = np.log(1 + (len(self.documents) - length + 0.5) / (length + 0.5))
+            norm = self.k1 * (
+                1 - self.b + self.b * self.doc_lengths[docs] / average_length
+            )
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+        return scores
+
+    def keyword_search(self, search_text, top=10, mask=None):
+        scores = self.bm25_scores(search_text)
+        # Documents matching no query term are not results
+        if mask is None:
+            mask = scores > 0
+        else:
+            mask = mask & (scores > 0)
+        return self.top_k(scores, top, mask)
+
+    def vector_search(self, vector, k=10, mask=None):
+        if self.embeddings is None:
+            raise ValueError("The index has no embeddings")
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+        # Cosine similarity, mapped to (0, 1] like the service's @search.score
+        scores = 1 / (2 - self.embeddings @ vector)
+        return self.top_k(scores, k, mask)
+
+    def search(self, payload):
+        """
+        Runs a docs/search request body: search, vectorQueries (kind "vector"), filter,
+        top and select. Hybrid queries are merged with reciprocal rank fusion.
+        Returns the response body, {"value": [documents with @search.score]}.
+        """
+        top = payload.get("top", 50)
+        mask = self.get_filter_mask(payload.get("filter"))
+        ranked_lists = []
+        search_text = payload.get("search")
+        if search_text and search_text != "*":
+            ranked_lists.append(self.keyword_search(search_text, top=top, mask=mask))
+        for vector_query in payload.get("vectorQueries") or []:
+            if vector_query.get("kind", "vector") != "vector":
+                raise ValueError(
+                    f"Unsupported vector query kind: {vector_query['kind']}"
+                )
+            ranked_lists.append(
+                self.vector_search(
+                    vector_query["vector"],
+                    k=vector_query.get("k", top),
+                    mask=mask,
+                )
+            )
+        if not ranked_lists:
+            # Match all documents, like search "*"
+            doc_ids = (
+                np.flatnonzero(mask)
+                if mask is not None
+                else np.arange(len(self.documents))
+            )
+            results = [(doc_id, 1.0) for doc_id in doc_ids[:top]]
+        elif len(ranked_lists) == 1:
+            doc_ids, scores = ranked_lists[0]
+            results = list(zip(doc_ids.tolist(), scores.tolist()))
+        else:
+            fused = defaultdict(float)
+            for doc_ids, _ in ranked_lists:
+                for rank, doc_id in enumerate(doc_ids.tolist()):
+                    fused[doc_id] += 1 / (RRF_K + rank + 1)
+            results = sorted(fused.items(), key=lambda item: -item[1])[:top]
+        select = payload.get("select")
+        fields = (
+            [field.strip() for field in select.split(",")]
+            if select
+            else DOCUMENT_FIELDS
+        )
+        return {
+            "value": [
+                {
+                    "@search.score": float(score),
+                    **{field: self.documents[doc_id].get(field) for field in fields},
+                }
+                for doc_id, score in results
+            ]
+        }
+
+
+def main():
+    if len(sys.argv) != 4 or sys.argv[1] not in ("build", "query"):
+        print(__doc__)
+        sys.exit(1)
+    command, source, target = sys.argv[1:]
+    if command == "build":
+        if os.path.isdir(source):
+            documents = iter_text_chunks(source)
+        else:
+            with open(source, encoding="utf-8") as f:
+                documents = [json.loads(line) for line in f if line.strip()]
+        start_time = time.perf_counter()
+        index = LocalSearchIndex().build(documents)
+        index.save(target)
+        print(
+            f"Indexed {len(index.documents)} chunks, {len(index.terms)} terms "
+            f"in {time.perf_counter() - start_time:.2f}s"
+        )
+    else:
+        index = LocalSearchIndex.load(source)
+        start_time = time.perf_counter()
+        response = index.search({"search": target, "top": 5})
+        elapsed = (time.perf_counter() - start_time) * 1000
+        for document in response["value"]:
+            print(
+                f"{document['@search.score']:.3f} {document['id']}: {document['chunk'][:80]!r}"
+            )
+        print(f"{len(response['value'])} results in {elapsed:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
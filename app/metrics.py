@@ -0,0 +1,198 @@
+"""
+Per-stage latency and token metrics of the chat path.
+Durations are kept in rolling windows summarised as p50/p95/p99, and exported as
+JSON lines, a Prometheus text file or a Prometheus /metrics HTTP endpoint.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class RollingHistogram:
+    """
+    Keeps the last window observations, and the count and sum of all of them.
+    """
+
+    def __init__(self, window=1000):
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.values:
+            return 0.0
+        values = sorted(self.values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            **{f"p{round(q * 100)}": self.quantile(q) for q in QUANTILES},
+        }
+
+
+class MetricsRegistry:
+    """
+    Thread safe registry of stage latency histograms (seconds) and token counters.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = RollingHistogram(self.window)
+            self.histograms[stage].observe(seconds)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "stages": {
+                    stage: histogram.summary()
+                    for stage, histogram in self.histograms.items()
+                },
+                "counters": dict(self.counters),
+            }
+
+    def to_prometheus(self, prefix="chat"):
+        snapshot = self.snapshot()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Latency of the chat stages, over the last {self.window} requests",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for stage, summary in sorted(snapshot["stages"].items()):
+            for q in QUANTILES:
+                lines.append(
+                    f'{prefix}_stage_seconds{{stage="{stage}",quantile="{q}"}} '
+                    f"{summary[f'p{round(q * 100)}']:.6f}"
+                )
+            lines.append(
+                f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {summary["sum"]:.6f}'
+            )
+            lines.append(
+                f'{prefix}_stage_seconds_count{{stage="{stage}"}} {summary["count"]}'
+            )
+        lines.append(f"# TYPE {prefix}_tokens_total counter")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f'{prefix}_tokens_total{{kind="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_file(self, path):
+        """
+        Writes the metrics for the node exporter textfile collector, atomically.
+        """
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+    def start_http_server(self, port, host="0.0.0.0"):
+        """
+        Serves the metrics in the Prometheus text format at /metrics, in a daemon thread.
+        """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class RequestTrace:
+    """
+    Spans of one chat request. The stage durations and tokens are recorded in the
+    registry, if given, once per request by finish.
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry
+        self.start_time = time.perf_counter()
+        self.durations = {}
+        self.tokens = {}
+        self.finished = False
+
+    @contextmanager
+    def span(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start_time)
+
+    def record(self, stage, seconds):
+        # Repeated spans of a stage (e.g. rendering) add up
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    def traced_seconds(self):
+        """
+        Returns the time covered by top level spans. Nested spans, named
+        "<stage>.<part>" (e.g. "retrieval.vector"), overlap their stage.
+        """
+        return sum(
+            seconds for stage, seconds in self.durations.items() if "." not in stage
+        )
+
+    def add_tokens(self, usage):
+        for kind in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            if isinstance(usage.get(kind), int):
+                self.tokens[kind] = self.tokens.get(kind, 0) + usage[kind]
+
+    def finish(self):
+        """
+        Records the request's total duration of each stage, and its tokens, in the
+        registry. Later calls do nothing.
+        """
+        if self.finished or self.registry is None:
+            return
+        self.finished = True
+        for stage, seconds in self.durations.items():
+            self.registry.observe(stage, seconds)
+        for kind, value in self.tokens.items():
+            self.registry.increment(kind.replace("_tokens", ""), value)
+
+    def to_record(self):
+        return {
+            "timestamp": time.time(),
+            "elapsed_seconds": time.perf_counter() - self.start_time,
+            "stages": self.durations,
+            "tokens": self.tokens,
+        }
+
+    def write_jsonl(self, path):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.to_record()) + "\n")
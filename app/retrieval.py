@@ -0,0 +1,216 @@
+"""
+Client-side hybrid retrieval over the vector index created by AISearchIndexer.
+The keyword (BM25 on chunk) and vector (embedding) sub-queries run concurrently,
+are fused with reciprocal rank fusion and deduplicated by parent_key, all within
+a latency budget.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+import aiohttp
+
+# Constant of the reciprocal rank fusion, as used by the service for hybrid queries
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(ranked_lists, k=RRF_K, key_field="id"):
+    """
+    Merges ranked lists of documents. Each document scores sum(1 / (k + rank)).
+    Returns the documents sorted by fused score, with the score in "@search.rrf".
+    """
+    fused, documents = {}, {}
+    for ranked_list in ranked_lists:
+        for rank, document in enumerate(ranked_list):
+            key = document[key_field]
+            fused[key] = fused.get(key, 0.0) + 1 / (k + rank + 1)
+            documents.setdefault(key, document)
+    return [
+        {**documents[key], "@search.rrf": score}
+        for key, score in sorted(fused.items(), key=lambda item: -item[1])
+    ]
+
+
+def dedupe_by_parent(documents, top, parent_field="parent_key"):
+    """
+    Keeps the best ranked chunk of each parent document, up to top results.
+    """
+    results, parents = [], set()
+    for document in documents:
+        parent = document.get(parent_field) or document.get("id")
+        if parent in parents:
+            continue
+        parents.add(parent)
+        results.append(document)
+        if len(results) == top:
+            break
+    return results
+
+
+class AzureSearchClient:
+    """
+    Async docs/search client for one index, over a pooled aiohttp session.
+    """
+
+    def __init__(self, endpoint, api_key, index_name, api_version="2023-10-01-Preview"):
+        self.url = f"{endpoint.rstrip('/')}/indexes('{index_name}')/docs/search.post.search?api-version={api_version}"
+        self.headers = {"Content-Type": "application/json", "api-key": api_key}
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=60),
+            )
+        return self.session
+
+    async def search(self, payload, timeout=None):
+        async with self.get_session().post(
+            self.url, json=payload, timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            if response.status != 200:
+                raise RuntimeError(
+                    f"Search FAILED: {response.status}|| {await response.text()}"
+                )
+            return (await response.json())["value"]
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class LocalSearchClient:
+    """
+    Async adapter of local_search.LocalSearchIndex, for development without a service.
+    """
+
+    def __init__(self, local_index):
+        self.local_index = local_index
+
+    async def search(self, payload, timeout=None):
+        response = await asyncio.to_thread(self.local_index.search, payload)
+        return response["value"]
+
+    async def close(self):
+        pass
+
+
+class HybridRetriever:
+    """
+    Retrieves the top context chunks for a query.
+    embed: optional function returning the query embedding. Without it, the vector
+    query is sent as text and embedded by the index's vectorizer.
+    """
+
+    def __init__(
+        self,
+        search_client,
+        top=5,
+        candidates=50,
+        timeout=1.5,
+        embed=None,
+        select="id,chunk,parent_key",
+    ):
+        self.search_client = search_client
+        self.top = top
+        self.candidates = candidates
+        self.timeout = timeout
+        self.embed = embed
+        self.select = select
+        self.loop = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    async def timed(name, coroutine, timings):
+        start_time = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            timings[f"{name}_ms"] = (time.perf_counter() - start_time) * 1000
+
+    async def keyword_search(self, query):
+        return await self.search_client.search(
+            {
+                "search": query,
+                "queryType": "simple",
+                "select": self.select,
+                "top": self.candidates,
+            },
+            timeout=self.timeout,
+        )
+
+    async def vector_search(self, query):
+        if self.embed is not None:
+            vector = await asyncio.to_thread(self.embed, query)
+            vector_query = {"kind": "vector", "vector": vector}
+        else:
+            vector_query = {"kind": "text", "text": query}
+        vector_query.update({"fields": "embedding", "k": self.candidates})
+        return await self.search_client.search(
+            {
+                "vectorQueries": [vector_query],
+                "select": self.select,
+                "top": self.candidates,
+            },
+            timeout=self.timeout,
+        )
+
+    async def aretrieve(self, query):
+        """
+        Returns (up to top chunks, timings in ms of the keyword and vector legs and
+        of the total). Sub-queries that fail or miss the latency budget are left out
+        of the fusion, so a slow leg degrades results instead of latency.
+        """
+        # Per call, as the retriever is shared by concurrent requests
+        timings = {}
+        start_time = time.perf_counter()
+        tasks = {
+            asyncio.ensure_future(self.timed(name, search(query), timings)): name
+            for name, search in (
+                ("keyword", self.keyword_search),
+                ("vector", self.vector_search),
+            )
+        }
+        done, pending = await asyncio.wait(tasks, timeout=self.timeout)
+        for task in pending:
+            logging.warning(f"{tasks[task]} search missed the {self.timeout}s budget")
+            task.cancel()
+            # Retrieve the error of a task that times out while being cancelled
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        ranked_lists = []
+        for task in done:
+            if task.exception() is not None:
+                logging.error(f"{tasks[task]} search FAILED. Error: {task.exception()}")
+            else:
+                ranked_lists.append(task.result())
+        results = dedupe_by_parent(reciprocal_rank_fusion(ranked_lists), self.top)
+        timings["total_ms"] = (time.perf_counter() - start_time) * 1000
+        return results, timings
+
+    def get_loop(self):
+        # A long lived loop keeps the search client's connections open between calls
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+            return self.loop
+
+    def retrieve(self, query):
+        """
+        Synchronous aretrieve, for callers without an event loop.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.aretrieve(query), self.get_loop()
+        ).result()
+
+
+def format_context(documents):
+    """
+    Formats retrieved chunks as numbered context blocks for the prompt.
+    """
+    return "\n\n".join(
+        f"[doc{i}] ({document.get('parent_key')})\n{document.get('chunk')}"
+        for i, document in enumerate(documents, start=1)
+    )
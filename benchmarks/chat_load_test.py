@@ -0,0 +1,493 @@
+"""
+Load tests the chat backend: replays a query log through get_cached_chat_response
+(and so get_chat_response or client side retrieval) at a given concurrency and
+arrival rate, and reports throughput, latency percentiles, errors and token usage.
+
+Usage:
+    python benchmarks/chat_load_test.py [--queries FILE] [--requests 200]
+        [--concurrency 10] [--rate 5] [--query-type vector] [--output FILE]
+
+FILE is a text file of one question per line, or a .jsonl file of {"query": ...}
+or {"messages": [...]} records. If omitted, sample questions are used.
+
+By default the OpenAI, embedding and search endpoints are replaced by a local stub
+server, with configurable latency (--llm-first-token-ms, --llm-token-ms,
+--search-ms, --embedding-ms, --jitter) and failure injection (--failure-rate,
+--failure-status). With --no-stubs, the endpoints configured in .env are used.
+
+Without --rate, each of the concurrency workers sends its next request as soon as
+the previous one completes (closed loop). With --rate, requests arrive as a
+Poisson process of rate per second (open loop) and latencies include the time
+spent queued for a worker.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from metrics import MetricsRegistry, RequestTrace, RollingHistogram  # noqa: E402
+
+SAMPLE_QUERIES = [
+    "How do I set up international roaming?",
+    "What is included in the basic mobile plan?",
+    "How can I pay my bill online?",
+    "Why is my internet slower than usual?",
+    "How do I upgrade my device before the end of my contract?",
+    "Is there an outage in my area?",
+    "How do I request a refund for an overcharge?",
+    "What data allowance comes with the family plan?",
+]
+WORDS = (
+    "plan mobile data roaming billing account support network coverage device "
+    "contract upgrade payment internet service customer outage refund"
+).split()
+
+
+class StubBehaviour:
+    """
+    Latency and failure injection of one stubbed service.
+    """
+
+    def __init__(
+        self, latency_ms=0.0, jitter=0.2, failure_rate=0.0, failure_status=500
+    ):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.rng = random.Random(0)
+        self.lock = threading.Lock()
+
+    def sample_delay(self, latency_ms=None):
+        latency_ms = self.latency_ms if latency_ms is None else latency_ms
+        with self.lock:
+            factor = 1 + self.rng.uniform(-self.jitter, self.jitter)
+        return max(0.0, latency_ms * factor / 1000)
+
+    def should_fail(self):
+        with self.lock:
+            return self.rng.random() < self.failure_rate
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text.split()) * 4 / 3)
+
+
+def stub_embedding(text, dims):
+    # Deterministic, so repeated questions are similar for the answer cache
+    rng = random.Random(hashlib.sha1(text.encode("utf-8")).digest())
+    return [rng.gauss(0, 1) for _ in range(dims)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves the chat completions (plain and "on your data" extension), embeddings
+    and search endpoints used by the chat app.
+    """
+
+    server_version = "ChatStub/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def fail(self, behaviour):
+        headers = {"Retry-After": "1"} if behaviour.failure_status == 429 else {}
+        self.send_json(
+            behaviour.failure_status,
+            {"error": {"code": str(behaviour.failure_status), "message": "Injected"}},
+            headers,
+        )
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        # Index definition and stats, fetched to version the answer cache
+        behaviour = self.server.behaviours["search"]
+        time.sleep(behaviour.sample_delay())
+        if self.path.split("?")[0].endswith("/stats"):
+            self.send_json(200, {"documentCount": 1000, "storageSize": 1000000})
+        else:
+            self.send_json(200, {"@odata.etag": '"stub"'})
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        body = self.read_body()
+        if path.endswith("/embeddings"):
+            service = "embedding"
+        elif path.endswith("/chat/completions"):
+            service = "llm"
+        else:
+            service = "search"
+        behaviour = self.server.behaviours[service]
+        if behaviour.should_fail():
+            time.sleep(behaviour.sample_delay())
+            self.fail(behaviour)
+            return
+        if service == "embedding":
+            time.sleep(behaviour.sample_delay())
+            embedding = stub_embedding(str(body.get("input")), self.server.dims)
+            self.send_json(200, {"data": [{"index": 0, "embedding": embedding}]})
+        elif service == "search":
+            time.sleep(behaviour.sample_delay())
+            self.send_json(200, {"value": self.search_results(body.get("top", 5))})
+        else:
+            self.chat_completion(body, behaviour, "/extensions/" in path)
+
+    def search_results(self, top):
+        return [
+            {
+                "id": f"chunk-{i}",
+                "parent_key": f"doc-{i // 2}",
+                "chunk": " ".join(WORDS[(i + j) % len(WORDS)] for j in range(100)),
+                "@search.score": 1 / (i + 1),
+            }
+            for i in range(min(top, 50))
+        ]
+
+    def chat_completion(self, body, behaviour, extension):
+        rng = random.Random(json.dumps(body.get("messages"), sort_keys=True))
+        completion_tokens = min(
+            self.server.completion_tokens, body.get("max_tokens") or 1000
+        )
+        tokens = [f"{rng.choice(WORDS)} " for _ in range(completion_tokens)]
+        prompt_tokens = sum(
+            estimate_tokens(m.get("content") or "") + 4
+            for m in body.get("messages", [])
+        )
+        if extension:
+            # The extension also sends the retrieved chunks to the model
+            prompt_tokens += 5 * 150
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        tool_message = {
+            "role": "tool",
+            "content": json.dumps(
+                {"citations": [{"filepath": f"doc-{i}"} for i in range(3)]}
+            ),
+        }
+        first_token_delay = behaviour.sample_delay()
+        token_delay = behaviour.sample_delay(self.server.token_ms)
+        if not body.get("stream"):
+            time.sleep(first_token_delay + token_delay * completion_tokens)
+            message = {"role": "assistant", "content": "".join(tokens)}
+            if extension:
+                message["context"] = {"messages": [tool_message]}
+            self.send_json(
+                200, {"choices": [{"index": 0, "message": message}], "usage": usage}
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        def send_event(choice, **fields):
+            if extension:
+                choice = {"index": 0, "messages": [{"delta": choice}]}
+            else:
+                choice = {"index": 0, "delta": choice}
+            event = {"choices": [choice], **fields}
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        if extension:
+            send_event(tool_message)
+        time.sleep(first_token_delay)
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(token_delay)
+            send_event({"content": token})
+        send_event({}, usage=usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_stub_server(behaviours, dims=1536, completion_tokens=150, token_ms=10.0):
+    """
+    Starts the stub server on a free local port, in a daemon thread.
+    behaviours: StubBehaviour of the "llm" (first token latency), "embedding" and
+    "search" services.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    server.behaviours = behaviours
+    server.dims = dims
+    server.completion_tokens = completion_tokens
+    server.token_ms = token_ms
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure_stub_environment(base_url, answer_cache):
+    """
+    Points the chat app at the stub server. Must run before chat_app is imported,
+    as it reads its configuration at import time.
+    """
+    os.environ.update(
+        {
+            "OPENAI_ENDPOINT": base_url,
+            "OPENAI_API_KEY": "stub",
+            "OPENAI_DEPLOYMENT": "stub-chat",
+            "AI_SEARCH_ENDPOINT": base_url,
+            "AI_SEARCH_KEY": "stub",
+            "AI_SEARCH_INDEX": "stub-index",
+            "VECTOR_EMBEDDING_URI": f"{base_url}/openai/deployments/stub-embedding/embeddings",
+            "VECTOR_EMBEDDING_API_KEY": "stub",
+            "ANSWER_CACHE_ENABLED": str(answer_cache),
+        }
+    )
+
+
+def load_queries(path):
+    """
+    Returns the chat histories to replay, without the system prompt.
+    """
+    if not path:
+        return [[{"role": "user", "content": query}] for query in SAMPLE_QUERIES]
+    histories = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if not path.endswith(".jsonl"):
+                histories.append([{"role": "user", "content": line}])
+                continue
+            record = json.loads(line)
+            if "messages" in record:
+                histories.append(
+                    [m for m in record["messages"] if m["role"] != "system"]
+                )
+            else:
+                histories.append([{"role": "user", "content": record["query"]}])
+    return histories
+
+
+def describe_error(error):
+    status = getattr(error, "http_status", None) or getattr(
+        getattr(error, "response", None), "status_code", None
+    )
+    return f"{type(error).__name__} {status}" if status else type(error).__name__
+
+
+def run_load(call, histories, requests, concurrency, rate=None, registry=None, seed=0):
+    """
+    Sends requests chat requests, cycling through histories.
+    call(history, metadata) returns the generator of answer pieces.
+    Returns (results, elapsed seconds); each result has the request's latency,
+    first token latency, error and token usage.
+    """
+    results = []
+    lock = threading.Lock()
+
+    def send(index, scheduled_time):
+        trace = RequestTrace(registry)
+        metadata = {"trace": trace}
+        start_time = scheduled_time if rate else time.perf_counter()
+        first_token_time, error = None, None
+        try:
+            for _ in call(histories[index % len(histories)], metadata):
+                if first_token_time is None:
+                    first_token_time = time.perf_counter()
+        except Exception as e:
+            error = describe_error(e)
+        end_time = time.perf_counter()
+        if error is None:
+            trace.record("first_token", (first_token_time or end_time) - start_time)
+            trace.record("total", end_time - start_time)
+            trace.add_tokens(metadata.get("usage", {}))
+        trace.finish()
+        with lock:
+            results.append(
+                {
+                    "latency": end_time - start_time,
+                    "first_token": (first_token_time or end_time) - start_time,
+                    "error": error,
+                    "tokens": trace.tokens,
+                    "cache_hit": metadata.get("usage", {}).get("cache") == "hit",
+                }
+            )
+
+    rng = random.Random(seed)
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        scheduled_time = start_time
+        for index in range(requests):
+            if rate:
+                scheduled_time += rng.expovariate(rate)
+                time.sleep(max(0.0, scheduled_time - time.perf_counter()))
+            executor.submit(send, index, scheduled_time)
+    return results, time.perf_counter() - start_time
+
+
+def summarize(results, elapsed, registry=None):
+    """
+    Returns the throughput, latency percentiles, error rates and token usage of a run.
+    """
+    successes = [result for result in results if result["error"] is None]
+    errors = {}
+    for result in results:
+        if result["error"] is not None:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+
+    def percentiles(values):
+        histogram = RollingHistogram(window=max(len(values), 1))
+        for value in values:
+            histogram.observe(value)
+        summary = histogram.summary()
+        summary["max"] = max(values, default=0.0)
+        return summary
+
+    tokens = {}
+    for result in successes:
+        for kind, value in result["tokens"].items():
+            tokens[kind] = tokens.get(kind, 0) + value
+    report = {
+        "requests": len(results),
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(successes) / elapsed if elapsed else 0.0,
+        "error_rate": (len(results) - len(successes)) / max(len(results), 1),
+        "errors": errors,
+        "cache_hits": sum(result["cache_hit"] for result in successes),
+        "latency": percentiles([result["latency"] for result in successes]),
+        "first_token": percentiles([result["first_token"] for result in successes]),
+        "tokens": tokens,
+        "tokens_per_second": {
+            kind: value / elapsed for kind, value in tokens.items() if elapsed
+        },
+    }
+    if registry is not None:
+        report["stages"] = registry.snapshot()["stages"]
+    return report
+
+
+def print_report(report):
+    print(
+        f"Requests: {report['requests']} in {report['elapsed_seconds']:.1f}s, "
+        f"throughput {report['throughput_rps']:.2f} req/s, "
+        f"error rate {report['error_rate']:.1%}, cache hits {report['cache_hits']}"
+    )
+    for error, count in sorted(report["errors"].items()):
+        print(f"  {error}: {count}")
+    print(f"{'seconds':<20} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for name in ("latency", "first_token"):
+        summary = report[name]
+        print(
+            f"{name:<20} {summary['p50']:>8.3f} {summary['p95']:>8.3f} "
+            f"{summary['p99']:>8.3f} {summary['max']:>8.3f}"
+        )
+    for stage, summary in sorted(report.get("stages", {}).items()):
+        if stage not in ("first_token", "total"):
+            print(
+                f"{stage:<20} {summary['p50']:>8.3f} {summary['p95']:>8.3f} "
+                f"{summary['p99']:>8.3f}"
+            )
+    for kind, value in sorted(report["tokens"].items()):
+        print(f"{kind}: {value} ({report['tokens_per_second'].get(kind, 0):.0f}/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--queries", default=None)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=None)
+    parser.add_argument("--query-type", default="vector")
+    parser.add_argument("--max-tokens", type=int, default=500)
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--answer-cache", action="store_true")
+    parser.add_argument("--no-stubs", action="store_true")
+    parser.add_argument("--llm-first-token-ms", type=float, default=500)
+    parser.add_argument("--llm-token-ms", type=float, default=10)
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    parser.add_argument("--embedding-ms", type=float, default=50)
+    parser.add_argument("--embedding-dims", type=int, default=1536)
+    parser.add_argument("--search-ms", type=float, default=100)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-status", type=int, default=500)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    if not args.no_stubs:
+        server = start_stub_server(
+            {
+                service: StubBehaviour(
+                    latency_ms, args.jitter, args.failure_rate, args.failure_status
+                )
+                for service, latency_ms in (
+                    ("llm", args.llm_first_token_ms),
+                    ("embedding", args.embedding_ms),
+                    ("search", args.search_ms),
+                )
+            },
+            dims=args.embedding_dims,
+            completion_tokens=args.completion_tokens,
+            token_ms=args.llm_token_ms,
+        )
+        configure_stub_environment(
+            f"http://127.0.0.1:{server.server_port}", args.answer_cache
+        )
+    else:
+        os.environ["ANSWER_CACHE_ENABLED"] = str(args.answer_cache)
+
+    import chat_app  # noqa: E402
+
+    def call(history, metadata):
+        return chat_app.get_cached_chat_response(
+            chat_history=chat_app.get_new_chat_history() + history,
+            metadata=metadata,
+            stream=not args.no_stream,
+            temperature=0.7,
+            top_p=0.95,
+            max_tokens=args.max_tokens,
+            queryType=args.query_type,
+        )
+
+    registry = MetricsRegistry(window=args.requests)
+    results, elapsed = run_load(
+        call,
+        load_queries(args.queries),
+        args.requests,
+        args.concurrency,
+        rate=args.rate,
+        registry=registry,
+    )
+    report = summarize(results, elapsed, registry)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+"""
+Sweeps the HNSW parameters of the vector index against an exact kNN baseline.
+
+Usage:
+    python benchmarks/hnsw_benchmark.py [--vectors FILE] [--k 10] [--min-recall 0.95]
+    python benchmarks/hnsw_benchmark.py --dump FILE
+
+FILE is a .npy matrix of embeddings, or a .jsonl file of documents with an
+"embedding" field. If omitted, a synthetic clustered corpus is generated.
+--dump exports the embeddings of VECTOR_INDEX_NAME (SEARCH_SERVICE_NAME and
+SEARCH_API_KEY must be set) to a .npy file, which the embedding field must be
+retrievable for. Pages are read with skip, so at most the first 100,000 documents
+are exported; a sample is enough for the benchmark.
+
+hnswlib is used if installed, else a (much slower) NumPy reference implementation.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Values accepted by the service for the hnswParameters of the index
+M_VALUES = [4, 6, 8, 10]
+EF_CONSTRUCTION_VALUES = [100, 200, 400]
+EF_SEARCH_VALUES = [100, 200, 500]
+
+
+def normalise(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def generate_vectors(size, dims, clusters=50, seed=0):
+    """
+    Clustered gaussian vectors, closer to text embeddings than uniform noise.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dims))
+    labels = rng.integers(0, clusters, size)
+    return normalise(centers[labels] + 0.6 * rng.standard_normal((size, dims)))
+
+
+def load_vectors(path):
+    if path.endswith(".npy"):
+        return normalise(np.load(path))
+    with open(path, encoding="utf-8") as f:
+        return normalise([json.loads(line)["embedding"] for line in f if line.strip()])
+
+
+# Largest skip the service accepts in a search query
+SEARCH_MAX_SKIP = 100000
+
+
+def dump_index_vectors(path, limit=SEARCH_MAX_SKIP, page_size=1000):
+    """
+    Saves up to limit embeddings of the vector index. The key is not sortable, so
+    pages are read in the service's order, which is stable while the index is not
+    being updated. limit is capped at SEARCH_MAX_SKIP.
+    """
+    from aisearch_utils import AISearchIndexer
+
+    index_name = os.environ["VECTOR_INDEX_NAME"]
+    search_indexer = AISearchIndexer(
+        search_service=os.environ["SEARCH_SERVICE_NAME"],
+        data_source_name=None,
+        search_index_name=None,
+        vector_index_name=index_name,
+        indexer_name=None,
+        vector_skillset_name=None,
+        api_key=os.environ["SEARCH_API_KEY"],
+    )
+    limit = min(limit, SEARCH_MAX_SKIP)
+    vectors = []
+    while len(vectors) < limit:
+        top = min(page_size, limit - len(vectors))
+        response = search_indexer.transport.post(
+            f"{search_indexer.endpoint}/indexes('{index_name}')/docs/search.post.search?api-version={search_indexer.api_version}",
+            json={
+                "search": "*",
+                "select": "id,embedding",
+                "top": top,
+                "skip": len(vectors),
+            },
+        )
+        response.raise_for_status()
+        page = [document["embedding"] for document in response.json()["value"]]
+        vectors.extend(page)
+        if len(page) < top:
+            break
+    np.save(path, np.asarray(vectors, dtype=np.float32))
+    print(f"Saved {len(vectors)} vectors to {path}")
+
+
+def exact_knn(vectors, queries, k, batch_size=1024):
+    """
+    Ground truth neighbours by cosine similarity (vectors are normalised).
+    """
+    neighbours = np.empty((len(queries), k), dtype=np.int64)
+    for i in range(0, len(queries), batch_size):
+        scores = queries[i : i + batch_size] @ vectors.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        neighbours[i : i + batch_size] = np.take_along_axis(top, order, axis=1)
+    return neighbours
+
+
+class NumpyHNSW:
+    """
+    Reference HNSW (Malkov & Yashunin) on cosine distance, for when hnswlib is not
+    installed. Neighbours are chosen with the diversity heuristic, which keeps
+    clustered data connected.
+    """
+
+    def __init__(self, m=4, ef_construction=400, seed=0):
+        self.m = m
+        self.max_links_0 = 2 * m
+        self.ef_construction = max(ef_construction, m)
+        self.level_mult = 1 / math.log(max(m, 2))
+        self.rng = random.Random(seed)
+        self.vectors = None
+        self.graphs = []
+        self.entry_point = None
+        self.max_level = -1
+
+    def distances(self, query, nodes):
+        return 1 - self.vectors[nodes] @ query
+
+    def search_layer(self, query, entry_points, ef, level):
+        visited = set(entry_points)
+        distances = self.distances(query, entry_points)
+        candidates = list(zip(distances.tolist(), entry_points))
+        heapq.heapify(candidates)
+        results = [(-distance, node) for distance, node in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+        graph = self.graphs[level]
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if distance > -results[0][0]:
+                break
+            neighbours = [n for n in graph[node] if n not in visited]
+            if not neighbours:
+                continue
+            visited.update(neighbours)
+            for neighbour_distance, neighbour in zip(
+                self.distances(query, neighbours).tolist(), neighbours
+            ):
+                if len(results) < ef or neighbour_distance < -results[0][0]:
+                    heapq.heappush(candidates, (neighbour_distance, neighbour))
+                    heapq.heappush(results, (-neighbour_distance, neighbour))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-distance, node) for distance, node in results)
+
+    def select_neighbours(self, candidates, m):
+        """
+        candidates: (distance, node) sorted by distance to the inserted vector.
+        Keeps a candidate only if it is closer to the vector than to any kept neighbour.
+        """
+        selected = []
+        for distance, node in candidates:
+            if len(selected) == m:
+                break
+            if (
+                not selected
+                or distance < self.distances(self.vectors[node], selected).min()
+            ):
+                selected.append(node)
+        return selected
+
+    def greedy_descend(self, query, target_level):
+        entry_points = [self.entry_point]
+        for level in range(self.max_level, target_level, -1):
+            entry_points = [self.search_layer(query, entry_points, 1, level)[0][1]]
+        return entry_points
+
+    def insert(self, node):
+        query = self.vectors[node]
+        level = int(-math.log(1 - self.rng.random()) * self.level_mult)
+        while len(self.graphs) <= level:
+            self.graphs.append({})
+        for layer in range(level + 1):
+            self.graphs[layer][node] = []
+        if self.entry_point is None:
+            self.entry_point, self.max_level = node, level
+            return
+        entry_points = self.greedy_descend(query, level)
+        for layer in range(min(level, self.max_level), -1, -1):
+            results = self.search_layer(
+                query, entry_points, self.ef_construction, layer
+            )
+            max_links = self.max_links_0 if layer == 0 else self.m
+            graph = self.graphs[layer]
+            graph[node] = self.select_neighbours(results, self.m)
+            for neighbour in graph[node]:
+                links = graph[neighbour] + [node]
+                if len(links) > max_links:
+                    distances = self.distances(self.vectors[neighbour], links).tolist()
+                    links = self.select_neighbours(
+                        sorted(zip(distances, links)), max_links
+                    )
+                graph[neighbour] = links
+            entry_points = [n for _, n in results]
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    def add_items(self, vectors):
+        self.vectors = vectors
+        for node in range(len(vectors)):
+            self.insert(node)
+
+    def knn_query(self, query, k, ef):
+        entry_points = self.greedy_descend(query, 0)
+        return [node for _, node in self.search_layer(query, entry_points, ef, 0)[:k]]
+
+
+def build_index(vectors, m, ef_construction, seed=0):
+    if hnswlib is not None:
+        index = hnswlib.Index(space="cosine", dim=vectors.shape[1])
+        index.init_index(
+            max_elements=len(vectors),
+            M=m,
+            ef_construction=ef_construction,
+            random_seed=seed,
+        )
+        index.add_items(vectors, num_threads=1)
+        return index
+    index = NumpyHNSW(m=m, ef_construction=ef_construction, seed=seed)
+    index.add_items(vectors)
+    return index
+
+
+def query_index(index, query, k, ef_search):
+    if hnswlib is not None:
+        index.set_ef(max(ef_search, k))
+        labels, _ = index.knn_query(query[np.newaxis, :], k=k, num_threads=1)
+        return labels[0]
+    return index.knn_query(query, k, max(ef_search, k))
+
+
+def estimate_index_bytes(size, dims, m):
+    """
+    HNSW memory: float32 vectors, 2*m links per node on the base layer, and on
+    average 1/(m-1) upper layers of m links per node.
+    """
+    links = 2 * m + m / max(m - 1, 1)
+    return int(size * (dims * 4 + links * 4 + 8))
+
+
+def run_config(vectors, queries, truth, k, m, ef_construction, ef_search_values):
+    start_time = time.perf_counter()
+    index = build_index(vectors, m, ef_construction)
+    build_seconds = time.perf_counter() - start_time
+    results = []
+    for ef_search in ef_search_values:
+        timings, hits = [], 0
+        for query, expected in zip(queries, truth):
+            start_time = time.perf_counter()
+            labels = query_index(index, query, k, ef_search)
+            timings.append(time.perf_counter() - start_time)
+            hits += len(set(np.asarray(labels).ravel().tolist()) & set(expected))
+        quantiles = statistics.quantiles(timings, n=100)
+        results.append(
+            {
+                "m": m,
+                "ef_construction": ef_construction,
+                "ef_search": ef_search,
+                "recall": hits / (len(queries) * k),
+                "p50_ms": statistics.median(timings) * 1000,
+                "p95_ms": quantiles[94] * 1000,
+                "p99_ms": quantiles[98] * 1000,
+                "build_s": build_seconds,
+                "memory_mb": estimate_index_bytes(len(vectors), vectors.shape[1], m)
+                / 1e6,
+            }
+        )
+    return results
+
+
+def recommend(results, min_recall):
+    """
+    Fastest configuration reaching min_recall, ties broken by memory then build time.
+    Falls back to the configuration with the highest recall.
+    """
+    eligible = [result for result in results if result["recall"] >= min_recall]
+    if not eligible:
+        return max(results, key=lambda result: result["recall"])
+    return min(
+        eligible,
+        key=lambda result: (
+            round(result["p95_ms"], 2),
+            result["memory_mb"],
+            result["build_s"],
+        ),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--vectors", default=None)
+    parser.add_argument("--dump", default=None)
+    parser.add_argument("--size", type=int, default=5000)
+    parser.add_argument("--dims", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--min-recall", type=float, default=0.95)
+    parser.add_argument("--m", type=int, nargs="+", default=M_VALUES)
+    parser.add_argument(
+        "--ef-construction", type=int, nargs="+", default=EF_CONSTRUCTION_VALUES
+    )
+    parser.add_argument("--ef-search", type=int, nargs="+", default=EF_SEARCH_VALUES)
+    args = parser.parse_args()
+
+    if args.dump:
+        dump_index_vectors(args.dump)
+        return
+
+    if args.vectors:
+        vectors = load_vectors(args.vectors)
+    else:
+        vectors = generate_vectors(args.size, args.dims)
+    # Held out queries: perturbed corpus vectors, as real queries are near documents
+    rng = np.random.default_rng(1)
+    sample = rng.choice(
+        len(vectors), size=min(args.queries, len(vectors)), replace=False
+    )
+    queries = normalise(
+        vectors[sample] + 0.1 * rng.standard_normal((len(sample), vectors.shape[1]))
+    )
+    start_time = time.perf_counter()
+    truth = exact_knn(vectors, queries, args.k).tolist()
+    exact_ms = (time.perf_counter() - start_time) * 1000 / len(queries)
+
+    backend = "hnswlib" if hnswlib is not None else "numpy reference"
+    print(
+        f"Corpus: {len(vectors)} x {vectors.shape[1]}, {len(queries)} queries, "
+        f"k = {args.k}, backend = {backend}"
+    )
+    print(f"Exact kNN (NumPy): {exact_ms:.3f} ms/query")
+    print(
+        f"{'m':>3} {'efC':>5} {'efS':>5} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'build s':>8} {'mem MB':>8}"
+    )
+    results = []
+    for m, ef_construction in itertools.product(args.m, args.ef_construction):
+        for result in run_config(
+            vectors, queries, truth, args.k, m, ef_construction, args.ef_search
+        ):
+            results.append(result)
+            print(
+                f"{result['m']:>3} {result['ef_construction']:>5} {result['ef_search']:>5} "
+                f"{result['recall']:>7.3f} {result['p50_ms']:>8.3f} {result['p95_ms']:>8.3f} "
+                f"{result['p99_ms']:>8.3f} {result['build_s']:>8.2f} {result['memory_mb']:>8.1f}"
+            )
+
+    best = recommend(results, args.min_recall)
+    print(
+        f"\nRecommended (recall@{args.k} = {best['recall']:.3f}, target {args.min_recall}):"
+    )
+    print(
+        f"    create_vector_index_payload(..., hnsw_m={best['m']}, "
+        f"hnsw_ef_construction={best['ef_construction']}, hnsw_ef_search={best['ef_search']})"
+    )
+    print(
+        f"    VECTOR_HNSW_M={best['m']} VECTOR_HNSW_EF_CONSTRUCTION={best['ef_construction']} "
+        f"VECTOR_HNSW_EF_SEARCH={best['ef_search']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
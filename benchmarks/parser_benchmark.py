@@ -0,0 +1,99 @@
+"""
+Benchmarks the HTML to text backends of WebCrawler.parse_html on a fixture corpus.
+
+Usage:
+    python benchmarks/parser_benchmark.py [--corpus DIR] [--repeat N]
+
+DIR is a directory of saved .html pages. If omitted, a synthetic corpus is generated.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from webcrawler import WebCrawler  # noqa: E402
+
+PARSER_LIBS = ["lxml", "bs4", "html2text"]
+WORDS = (
+    "plan mobile data roaming billing account support network coverage device "
+    "contract upgrade payment internet service customer outage refund"
+).split()
+
+
+def generate_page(rng, sections=20):
+    def sentence():
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 25))) + "."
+
+    body = ["<nav><ul>" + "<li><a href='#'>menu</a></li>" * 15 + "</ul></nav>"]
+    for i in range(sections):
+        body.append(f"<h2>Section {i}</h2>")
+        body.extend(
+            f"<p>{sentence()} <a href='#'>{sentence()}</a> {sentence()}</p>"
+            for _ in range(rng.randint(2, 6))
+        )
+        body.append("<script>var tracking = {id: 1, events: []};</script>")
+    body.append("<footer>" + sentence() * 10 + "</footer>")
+    html = (
+        "<html><head><title>Page</title><style>p {margin: 0}</style></head>"
+        f"<body><main>{''.join(body)}</main></body></html>"
+    )
+    return html.encode("utf-8")
+
+
+def load_corpus(corpus_dir, size=200, seed=0):
+    if corpus_dir:
+        pages = []
+        for file_name in sorted(os.listdir(corpus_dir)):
+            if file_name.endswith((".html", ".htm")):
+                with open(os.path.join(corpus_dir, file_name), "rb") as f:
+                    pages.append(f.read())
+        return pages
+    rng = random.Random(seed)
+    return [generate_page(rng) for _ in range(size)]
+
+
+def benchmark(pages, parser_lib, repeat=3):
+    crawler = WebCrawler()
+    timings, output_chars = [], 0
+    for _ in range(repeat):
+        for html in pages:
+            start_time = time.perf_counter()
+            text = crawler.parse_html(html, parser_lib=parser_lib)
+            timings.append(time.perf_counter() - start_time)
+        output_chars = len(text)
+    total = sum(timings) / repeat
+    return {
+        "parser_lib": parser_lib,
+        "pages_per_sec": len(pages) / total if total else 0.0,
+        "p50_ms": statistics.median(timings) * 1000,
+        "p95_ms": statistics.quantiles(timings, n=20)[-1] * 1000,
+        "last_output_chars": output_chars,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pages = load_corpus(args.corpus)
+    input_mb = sum(len(page) for page in pages) / 1e6
+    print(f"Corpus: {len(pages)} pages, {input_mb:.1f} MB")
+    print(f"{'parser':<10} {'pages/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'chars':>10}")
+    for parser_lib in PARSER_LIBS:
+        result = benchmark(pages, parser_lib, repeat=args.repeat)
+        print(
+            f"{result['parser_lib']:<10} {result['pages_per_sec']:>10.1f} "
+            f"{result['p50_ms']:>10.2f} {result['p95_ms']:>10.2f} "
+            f"{result['last_output_chars']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Estimates the memory saved and recall lost by the vector compression options of
+the vector index, on a sample of embeddings.
+
+Usage:
+    python benchmarks/vector_compression_benchmark.py [--vectors FILE] [--k 10]
+
+FILE is a .npy or .jsonl embeddings dump, as written by hnsw_benchmark.py --dump.
+If omitted, a synthetic clustered corpus is generated.
+
+Each option is searched exhaustively on the compressed vectors. For the scalar and
+binary compressions, the top k * oversampling candidates are then rescored with the
+full precision vectors, as the service does with rerankWithOriginalVectors. Narrow
+types (Edm.Half) keep no full precision copy, so they are scored as stored.
+"""
+
+import argparse
+import numpy as np
+
+from hnsw_benchmark import exact_knn, generate_vectors, load_vectors, normalise
+
+
+def top_k(scores, k):
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def quantize_half(vectors):
+    codes = vectors.astype(np.float16)
+    return codes, codes.astype(np.float32), lambda queries: queries
+
+
+def quantize_scalar(vectors):
+    """
+    int8 scalar quantization with per-dimension min/max ranges.
+    """
+    low, high = vectors.min(axis=0), vectors.max(axis=0)
+    scale = np.maximum(high - low, 1e-12) / 255
+    codes = (np.round((vectors - low) / scale) - 128).astype(np.int8)
+    return (
+        codes,
+        (codes.astype(np.float32) + 128) * scale + low,
+        lambda queries: queries,
+    )
+
+
+def quantize_binary(vectors):
+    """
+    One bit per dimension (the sign). The dot product of the +-1 sign vectors
+    ranks like the Hamming distance of the bit codes.
+    """
+    codes = np.packbits(vectors > 0, axis=1)
+    signs = np.where(vectors > 0, 1.0, -1.0).astype(np.float32)
+    return codes, signs, lambda queries: np.where(queries > 0, 1.0, -1.0)
+
+
+OPTIONS = {
+    "Edm.Single": lambda vectors: (vectors, vectors, lambda queries: queries),
+    "Edm.Half": quantize_half,
+    "scalar (int8)": quantize_scalar,
+    "binary": quantize_binary,
+}
+# Compressions for which the service keeps the original vectors to rescore with
+RESCORED_OPTIONS = {"scalar (int8)", "binary"}
+
+
+def recall(results, truth, k):
+    return np.mean(
+        [
+            len(set(row[:k].tolist()) & set(expected)) / k
+            for row, expected in zip(results, truth)
+        ]
+    )
+
+
+def evaluate(vectors, queries, truth, k, oversampling_values, batch_size=256):
+    rows = []
+    baseline_bytes = vectors.nbytes
+    for name, quantize in OPTIONS.items():
+        codes, scoring_vectors, transform = quantize(vectors)
+        rescored = name in RESCORED_OPTIONS
+        for oversampling in oversampling_values if rescored else [1]:
+            results = []
+            for i in range(0, len(queries), batch_size):
+                batch = queries[i : i + batch_size]
+                candidates = top_k(
+                    transform(batch) @ scoring_vectors.T, k * oversampling
+                )
+                if not rescored:
+                    results.extend(candidates)
+                    continue
+                # Rescore the candidates with the full precision vectors
+                exact_scores = np.einsum("qd,qcd->qc", batch, vectors[candidates])
+                order = np.argsort(-exact_scores, axis=1)[:, :k]
+                results.extend(np.take_along_axis(candidates, order, axis=1))
+            rows.append(
+                {
+                    "option": name,
+                    "oversampling": oversampling,
+                    "recall": recall(results, truth, k),
+                    "vector_mb": codes.nbytes / 1e6,
+                    "saved": 1 - codes.nbytes / baseline_bytes,
+                }
+            )
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--vectors", default=None)
+    parser.add_argument("--size", type=int, default=20000)
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--sample", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--oversampling", type=int, nargs="+", default=[1, 4, 10])
+    args = parser.parse_args()
+
+    if args.vectors:
+        vectors = load_vectors(args.vectors)
+    else:
+        vectors = generate_vectors(args.size, args.dims)
+    rng = np.random.default_rng(1)
+    if len(vectors) > args.sample:
+        vectors = vectors[rng.choice(len(vectors), size=args.sample, replace=False)]
+    sample = rng.choice(
+        len(vectors), size=min(args.queries, len(vectors)), replace=False
+    )
+    queries = normalise(
+        vectors[sample] + 0.1 * rng.standard_normal((len(sample), vectors.shape[1]))
+    )
+    truth = exact_knn(vectors, queries, args.k).tolist()
+
+    print(
+        f"Sample: {len(vectors)} x {vectors.shape[1]}, {len(queries)} queries, k = {args.k}"
+    )
+    print(
+        f"{'option':<15} {'oversampling':>12} {'recall':>7} {'vector MB':>10} {'saved':>7}"
+    )
+    for row in evaluate(vectors, queries, truth, args.k, args.oversampling):
+        print(
+            f"{row['option']:<15} {row['oversampling']:>12} {row['recall']:>7.3f} "
+            f"{row['vector_mb']:>10.1f} {row['saved']:>7.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
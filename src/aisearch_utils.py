@@ -1,6 +1,35 @@
 import requests
 import uuid
 import logging
+import json
+import hashlib
+import random
+import time
+import datetime
+import re
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from search_transport import SearchTransport
+
+# Fields holding credentials, which the service never returns as written
+SECRET_FIELDS = {"apiKey", "connectionString", "storageConnectionString"}
+# Vector compression options of the vector index, see create_vector_index_payload
+VECTOR_COMPRESSION_KINDS = {
+    "scalar": "scalarQuantization",
+    "binary": "binaryQuantization",
+}
+# Fractional seconds beyond microseconds, which older Pythons cannot parse
+EXTRA_FRACTION_DIGITS = re.compile(r"(\.\d{6})\d+")
+
+
+def parse_search_datetime(value):
+    """
+    Parses a datetime returned by the search service, e.g. "2024-01-01T10:00:00.1234567Z".
+    """
+    if not value:
+        return None
+    value = EXTRA_FRACTION_DIGITS.sub(r"\1", value.replace("Z", "+00:00"))
+    return datetime.datetime.fromisoformat(value)
 
 
 class AISearchIndexer:
@@ -15,6 +44,8 @@ class AISearchIndexer:
         api_key,
         api_version="2023-10-01-Preview",
         # api_version="2023-11-01",
+        endpoint=None,
+        transport=None,
     ):
         self.search_service = search_service
         self.data_source_name = data_source_name
@@ -30,14 +61,24 @@ class AISearchIndexer:
         self.vector_search_config = self.generate_service_name("vector-search-config")
         self.vector_search_vectorizer = self.generate_service_name("vectorizer")
         self.semantic_config = self.generate_service_name("semantic-config")
-        self.endpoint = f"https://{self.search_service}.search.windows.net"
+        self.endpoint = endpoint or f"https://{self.search_service}.search.windows.net"
+        # Pooled, retrying HTTP transport shared by all REST calls
+        self.transport = transport or SearchTransport(headers=self.headers)
+        # Push mode batch sizing, adapted to the service's responses
+        self.min_upload_batch_size = 10
+        self.max_upload_batch_size = 1000
+        self.max_upload_batch_bytes = 12 * 1024 * 1024
+        self.upload_batch_size = 100
+        self.upload_backoff = 1
 
     def generate_service_name(self, service_name_prefix):
-        # Generate a UUID
-        uuid_str = str(uuid.uuid4())
+        # Derive a stable suffix from the vector index name (or the keyword index
+        # name without a vector index), so the same definition is generated every run
+        index_name = self.vector_index_name or self.search_index_name or ""
+        suffix = hashlib.sha1(index_name.encode("utf-8")).hexdigest()
 
-        # Concatenate the prefix and the UUID
-        service_name = service_name_prefix + "-" + uuid_str
+        # Concatenate the prefix and the suffix
+        service_name = service_name_prefix + "-" + suffix
 
         # Truncate the service name to the maximum size if necessary
         if len(service_name) > self.max_service_name_size:
@@ -45,6 +86,77 @@ class AISearchIndexer:
 
         return service_name
 
+    def get_resource(self, resource_type, name):
+        """
+        Returns the deployed definition of a resource, or None if it does not exist.
+        resource_type: "datasources", "indexes", "skillsets" or "indexers"
+        """
+        response = self.transport.get(
+            f"{self.endpoint}/{resource_type}('{name}')?api-version={self.api_version}",
+        )
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+    @staticmethod
+    def project_definition(deployed, desired):
+        """
+        Returns the parts of the deployed definition that the desired one specifies.
+        Service defaults (keys absent or None in desired) are ignored, and so are
+        secrets, which the service does not return.
+        """
+        if isinstance(desired, dict):
+            if not isinstance(deployed, dict):
+                return deployed
+            return {
+                key: (
+                    value
+                    if key in SECRET_FIELDS
+                    else AISearchIndexer.project_definition(deployed.get(key), value)
+                )
+                for key, value in desired.items()
+                if value is not None
+            }
+        if isinstance(desired, list):
+            if not isinstance(deployed, list) or len(deployed) != len(desired):
+                return deployed
+            return [
+                AISearchIndexer.project_definition(deployed_item, desired_item)
+                for deployed_item, desired_item in zip(deployed, desired)
+            ]
+        # Settings read from the environment are strings, the service returns numbers
+        if isinstance(desired, str) and isinstance(deployed, (int, float)):
+            return str(deployed)
+        return deployed
+
+    @staticmethod
+    def definition_fingerprint(definition):
+        definition = AISearchIndexer.project_definition(definition, definition)
+        return hashlib.sha256(
+            json.dumps(definition, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def put_resource(self, resource_type, name, payload):
+        """
+        Creates or updates a resource, unless the deployed definition already matches
+        the fingerprint of the desired one.
+        """
+        deployed = self.get_resource(resource_type, name)
+        if deployed is not None and self.definition_fingerprint(
+            payload
+        ) == self.definition_fingerprint(self.project_definition(deployed, payload)):
+            logging.info(f"{resource_type} {name} is up to date. Skipping update.")
+            return True
+        response = self.transport.put(
+            f"{self.endpoint}/{resource_type}('{name}')?api-version={self.api_version}",
+            json=payload,
+        )
+        if response.status_code in [200, 201, 204]:
+            return True
+        else:
+            logging.error(f"ERROR: {response.status_code}|| {response.text}")
+            return False
+
     def create_data_source_blob_storage(
         self, blob_connection, blob_container_name, query
     ):
@@ -60,36 +172,25 @@ class AISearchIndexer:
             },
         }
 
-        response = requests.put(
-            f"{self.endpoint}/datasources('{self.data_source_name}')?api-version={self.api_version}",
-            headers=self.headers,
-            json=data_source_payload,
+        return self.put_resource(
+            "datasources", self.data_source_name, data_source_payload
         )
-        if response.status_code in [200, 201, 204]:
-            # self.data_source = response.json()
-            return True
-        else:
-            logging.error(f"ERROR: {response.status_code}")
-            return False
 
     def check_data_source_exists(self):
-        response = requests.get(
+        response = self.transport.get(
             f"{self.endpoint}/datasources('{self.data_source_name}')?api-version={self.api_version}",
-            headers=self.headers,
         )
         return response.status_code == 200
 
     def check_index_exists(self, index_name):
-        response = requests.get(
+        response = self.transport.get(
             f"{self.endpoint}/indexes('{index_name}')?api-version={self.api_version}",
-            headers=self.headers,
         )
         return response.status_code == 200
 
     def check_indexer_exists(self):
-        response = requests.get(
+        response = self.transport.get(
             f"{self.endpoint}/indexers('{self.indexer_name}')?api-version={self.api_version}",
-            headers=self.headers,
         )
         return response.status_code == 200
 
@@ -147,8 +248,64 @@ class AISearchIndexer:
         return index_payload
 
     def create_vector_index_payload(
-        self, model_uri, model_name, model_api_key, embedding_dims
+        self,
+        model_uri,
+        model_name,
+        model_api_key,
+        embedding_dims,
+        hnsw_m=4,
+        hnsw_ef_construction=400,
+        hnsw_ef_search=500,
+        vector_type="Edm.Single",
+        vector_compression=None,
+        compression_oversampling=10,
+        vector_retrievable=True,
+        vector_stored=True,
     ):
+        """
+        HNSW parameters can be tuned with benchmarks/hnsw_benchmark.py.
+        The service accepts m in [4, 10], efConstruction and efSearch in [100, 1000].
+        Vector storage can be reduced with vector_type "Edm.Half", vector_compression
+        "scalar" (int8) or "binary", and non-retrievable or unstored vectors. These
+        need api_version 2024-05-01-Preview or later, and their recall loss can be
+        estimated with benchmarks/vector_compression_benchmark.py.
+        """
+        embedding_field = {
+            "name": "embedding",
+            "type": f"Collection({vector_type})",
+            "searchable": True,
+            "filterable": False,
+            # Unstored vectors cannot be returned
+            "retrievable": vector_retrievable and vector_stored,
+            "sortable": False,
+            "facetable": False,
+            "key": False,
+            "dimensions": embedding_dims,
+            "vectorSearchProfile": self.vector_search_profile,
+            "synonymMaps": [],
+        }
+        if not vector_stored:
+            embedding_field["stored"] = False
+        vector_profile = {
+            "name": self.vector_search_profile,
+            "algorithm": self.vector_search_config,
+            "vectorizer": self.vector_search_vectorizer,
+        }
+        compressions = []
+        if vector_compression:
+            compression = {
+                "name": self.generate_service_name("vector-compression"),
+                "kind": VECTOR_COMPRESSION_KINDS[vector_compression],
+                # Rescore the quantized candidates with the full precision vectors
+                "rerankWithOriginalVectors": True,
+                "defaultOversampling": compression_oversampling,
+            }
+            if vector_compression == "scalar":
+                compression["scalarQuantizationParameters"] = {
+                    "quantizedDataType": "int8"
+                }
+            compressions.append(compression)
+            vector_profile["compression"] = compression["name"]
         index_payload = {
             "name": self.vector_index_name,
             "defaultScoringProfile": "",
@@ -187,19 +344,7 @@ class AISearchIndexer:
                     "facetable": False,
                     "key": False,
                 },
-                {
-                    "name": "embedding",
-                    "type": "Collection(Edm.Single)",
-                    "searchable": True,
-                    "filterable": False,
-                    "retrievable": True,
-                    "sortable": False,
-                    "facetable": False,
-                    "key": False,
-                    "dimensions": embedding_dims,
-                    "vectorSearchProfile": self.vector_search_profile,
-                    "synonymMaps": [],
-                },
+                embedding_field,
             ],
             "scoringProfiles": [],
             "corsOptions": None,
@@ -240,20 +385,14 @@ class AISearchIndexer:
                             # use cosine similarity when using OpenAI models,
                             # else use the distance metric of the embedding model
                             "metric": "cosine",
-                            "m": 4,  # bi-directional link count
-                            "efConstruction": 400,  # number of nearest neighbors to consider during indexiing
-                            "efSearch": 500,  # number of nearest neighbors to consider during search
+                            "m": hnsw_m,  # bi-directional link count
+                            "efConstruction": hnsw_ef_construction,  # number of nearest neighbors to consider during indexiing
+                            "efSearch": hnsw_ef_search,  # number of nearest neighbors to consider during search
                         },
                         "exhaustiveKnnParameters": None,
                     }
                 ],
-                "profiles": [
-                    {
-                        "name": self.vector_search_profile,
-                        "algorithm": self.vector_search_config,
-                        "vectorizer": self.vector_search_vectorizer,
-                    }
-                ],
+                "profiles": [vector_profile],
                 "vectorizers": [
                     {
                         "name": self.vector_search_vectorizer,
@@ -268,6 +407,8 @@ class AISearchIndexer:
                 ],
             },
         }
+        if compressions:
+            index_payload["vectorSearch"]["compressions"] = compressions
         return index_payload
 
     def create_index(self, index_type="search", **kwargs):
@@ -278,17 +419,7 @@ class AISearchIndexer:
             elif index_type == "vector":
                 index_payload = self.create_vector_index_payload(**kwargs)
                 index_name = self.vector_index_name
-            response = requests.put(
-                f"{self.endpoint}/indexes('{index_name}')?api-version={self.api_version}",
-                headers=self.headers,
-                json=index_payload,
-            )
-            if response.status_code in [200, 201, 204]:
-                # self.index = response.json()
-                return True
-            else:
-                logging.error(f"ERROR: {response.status_code}|| {response.text}")
-                return False
+            return self.put_resource("indexes", index_name, index_payload)
         else:
             return False
 
@@ -352,17 +483,9 @@ class AISearchIndexer:
                     "parameters": {},
                 },
             }
-            response = requests.put(
-                f"{self.endpoint}/skillsets('{self.vector_skillset_name}')?api-version={self.api_version}",
-                headers=self.headers,
-                json=skillset_payload,
+            return self.put_resource(
+                "skillsets", self.vector_skillset_name, skillset_payload
             )
-            if response.status_code in [200, 201, 204]:
-                # self.skillset = response.json()
-                return True
-            else:
-                logging.error(f"ERROR: {response.status_code}")
-                return False
 
     def create_indexer(self, cache_storage_connection, batch_size=100):
         if self.check_index_exists(self.search_index_name) and self.check_index_exists(
@@ -388,17 +511,7 @@ class AISearchIndexer:
                     "storageConnectionString": cache_storage_connection,
                 },
             }
-            response = requests.put(
-                f"{self.endpoint}/indexers('{self.indexer_name}')?api-version={self.api_version}",
-                headers=self.headers,
-                json=indexer_payload,
-            )
-            if response.status_code in [200, 201, 204]:
-                # self.indexer = response.json()
-                return True
-            else:
-                logging.error(f"ERROR: {response.status_code}")
-                return False
+            return self.put_resource("indexers", self.indexer_name, indexer_payload)
         else:
             return False
 
@@ -408,15 +521,13 @@ class AISearchIndexer:
                 "x-ms-client-request-id": str(uuid.uuid4()),
             }
             if reset_flag:
-                response = requests.post(
+                response = self.transport.post(
                     f"{self.endpoint}/indexers('{self.indexer_name}')/search.reset?api-version={self.api_version}",
-                    headers=self.headers,
                     json=indexer_payload,
                 )
                 assert response.status_code == 204, "Indexer reset failed."
-            response = requests.post(
+            response = self.transport.post(
                 f"{self.endpoint}/indexers('{self.indexer_name}')/search.run?api-version={self.api_version}",
-                headers=self.headers,
                 json=indexer_payload,
             )
             if response.status_code in [202]:
@@ -424,3 +535,320 @@ class AISearchIndexer:
             else:
                 logging.error(f"{response.status_code}")
                 return False
+
+    def reset_documents(self, document_keys):
+        """
+        Queues documents of the keyword index for reprocessing on the next indexer
+        run, instead of resetting the whole indexer.
+        """
+        if not document_keys:
+            return True
+        response = self.transport.post(
+            f"{self.endpoint}/indexers('{self.indexer_name}')/search.resetdocs?overwrite=false&api-version={self.api_version}",
+            json={"documentKeys": list(document_keys)},
+        )
+        if response.status_code in [200, 204]:
+            logging.info(f"Reset {len(document_keys)} documents of {self.indexer_name}")
+            return True
+        else:
+            logging.error(f"ERROR: {response.status_code}|| {response.text}")
+            return False
+
+    @staticmethod
+    def get_search_in_filter(field_name, values):
+        escaped = "|".join(value.replace("'", "''") for value in values)
+        return f"search.in({field_name}, '{escaped}', '|')"
+
+    def search_document_keys_in(
+        self, index_name, field_name, values, key_field="id", batch_size=100
+    ):
+        """
+        Returns the keys of the documents whose field_name is one of values.
+        """
+        values, keys = list(values), []
+        for i in range(0, len(values), batch_size):
+            keys.extend(
+                self.search_document_keys(
+                    index_name,
+                    self.get_search_in_filter(field_name, values[i : i + batch_size]),
+                    key_field=key_field,
+                )
+            )
+        return keys
+
+    def delete_chunks(self, parent_keys):
+        """
+        Deletes the vector index chunks projected from the given parent documents.
+        """
+        chunk_keys = self.search_document_keys_in(
+            self.vector_index_name, "parent_key", parent_keys
+        )
+        if chunk_keys:
+            logging.info(f"Deleting {len(chunk_keys)} chunks from the vector index")
+            return self.delete_documents(self.vector_index_name, chunk_keys)
+        return True
+
+    def get_indexer_status(self):
+        """
+        Returns the indexer status, including lastResult and executionHistory,
+        or None if it cannot be read.
+        """
+        response = self.transport.get(
+            f"{self.endpoint}/indexers('{self.indexer_name}')/search.status?api-version={self.api_version}",
+        )
+        if response.status_code != 200:
+            logging.error(f"ERROR: {response.status_code}|| {response.text}")
+            return None
+        return response.json()
+
+    def get_last_execution(self):
+        status = self.get_indexer_status()
+        return (status or {}).get("lastResult")
+
+    @staticmethod
+    def get_execution_metrics(execution):
+        """
+        Returns the metrics of an indexer execution (an item of the status executionHistory).
+        """
+        start_time = parse_search_datetime(execution.get("startTime"))
+        end_time = parse_search_datetime(execution.get("endTime")) or (
+            datetime.datetime.now(datetime.timezone.utc)
+        )
+        elapsed = (end_time - start_time).total_seconds() if start_time else 0.0
+        items_processed = execution.get("itemsProcessed", 0)
+        return {
+            "status": execution.get("status"),
+            "start_time": execution.get("startTime"),
+            "end_time": execution.get("endTime"),
+            "elapsed_seconds": elapsed,
+            "items_processed": items_processed,
+            "items_failed": execution.get("itemsFailed", 0),
+            "docs_per_second": items_processed / elapsed if elapsed > 0 else 0.0,
+            "error_message": execution.get("errorMessage"),
+            "errors": [
+                {
+                    "key": error.get("key"),
+                    "status_code": error.get("statusCode"),
+                    "error_message": error.get("errorMessage"),
+                }
+                for error in execution.get("errors") or []
+            ],
+            "warnings": len(execution.get("warnings") or []),
+        }
+
+    def wait_for_indexer(
+        self,
+        previous_execution=None,
+        timeout=None,
+        poll_interval=5,
+        max_poll_interval=60,
+    ):
+        """
+        Polls the indexer status, with backoff, until its run completes.
+        previous_execution is the lastResult read before the run was requested, so that
+        it is not mistaken for the new run.
+        Returns the run metrics (status "inProgress" if timeout seconds elapsed first),
+        or None if no run was seen.
+        """
+        previous_start_time = (previous_execution or {}).get("startTime")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        execution = None
+        while True:
+            status = self.get_indexer_status()
+            last_result = (status or {}).get("lastResult")
+            if last_result and last_result.get("startTime") != previous_start_time:
+                execution = last_result
+                if execution.get("status") != "inProgress":
+                    metrics = self.get_execution_metrics(execution)
+                    logging.info(
+                        f"Indexer {self.indexer_name} run {metrics['status']}: "
+                        f"{metrics['items_processed']} items processed, "
+                        f"{metrics['items_failed']} failed in {metrics['elapsed_seconds']:.1f}s "
+                        f"({metrics['docs_per_second']:.2f} docs/s)"
+                    )
+                    return metrics
+            if deadline is not None and time.monotonic() + poll_interval > deadline:
+                logging.warning(
+                    f"Indexer {self.indexer_name} run did not complete in {timeout}s"
+                )
+                return self.get_execution_metrics(execution) if execution else None
+            time.sleep(poll_interval)
+            poll_interval = min(max_poll_interval, poll_interval * 1.5)
+
+    def post_index_batch(self, index_name, batch, action):
+        """
+        Sends one docs/index request.
+        Returns (status_code, {key: (succeeded, status_code, error_message)}).
+        """
+        key_field, documents = batch
+        payload = {
+            "value": [{"@search.action": action, **document} for document in documents]
+        }
+        response = self.transport.post(
+            f"{self.endpoint}/indexes('{index_name}')/docs/search.index?api-version={self.api_version}",
+            json=payload,
+            # Throttling is handled by upload_documents, which resizes the batches
+            max_retries=0,
+        )
+        if response.status_code not in [200, 207]:
+            return response.status_code, {}
+        return response.status_code, {
+            result["key"]: (
+                result["status"],
+                result["statusCode"],
+                result.get("errorMessage"),
+            )
+            for result in response.json()["value"]
+        }
+
+    def upload_documents(
+        self,
+        index_name,
+        documents,
+        key_field="id",
+        action="mergeOrUpload",
+        max_concurrency=4,
+        max_retries=5,
+    ):
+        """
+        Pushes documents to the index in parallel batches.
+        The batch size grows while batches succeed, and shrinks on 207 partial failures,
+        throttling (429/503) and oversized payloads. Only the failed keys are retried.
+        Returns a dict of succeeded (count), failed ({key: error}) and batch_size.
+        """
+        documents = iter(documents)
+        retry_queue = deque()
+        attempts, failed, succeeded = {}, {}, 0
+
+        def next_batch():
+            batch, batch_bytes = [], 0
+            while len(batch) < self.upload_batch_size:
+                if retry_queue:
+                    document = retry_queue.popleft()
+                else:
+                    document = next(documents, None)
+                    if document is None:
+                        break
+                document_bytes = len(json.dumps(document))
+                if batch and batch_bytes + document_bytes > self.max_upload_batch_bytes:
+                    retry_queue.appendleft(document)
+                    break
+                batch.append(document)
+                batch_bytes += document_bytes
+            return batch
+
+        def retry_or_fail(document, error):
+            key = document[key_field]
+            attempts[key] = attempts.get(key, 0) + 1
+            if attempts[key] > max_retries:
+                failed[key] = error
+            else:
+                retry_queue.append(document)
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            in_flight = {}
+            while True:
+                while len(in_flight) < max_concurrency:
+                    batch = next_batch()
+                    if not batch:
+                        break
+                    future = executor.submit(
+                        self.post_index_batch, index_name, (key_field, batch), action
+                    )
+                    in_flight[future] = batch
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                throttled = False
+                for future in done:
+                    batch = in_flight.pop(future)
+                    try:
+                        status_code, results = future.result()
+                    except requests.RequestException as e:
+                        status_code, results = 503, {}
+                        logging.warning(f"Index batch request FAILED. Error: {e}")
+                    if status_code in [413, 429] or status_code >= 500:
+                        throttled = True
+                        for document in batch:
+                            retry_or_fail(document, f"HTTP {status_code}")
+                        continue
+                    if status_code not in [200, 207]:
+                        for document in batch:
+                            failed[document[key_field]] = f"HTTP {status_code}"
+                        continue
+                    for document in batch:
+                        ok, item_status, error = results.get(
+                            document[key_field], (False, None, "missing result")
+                        )
+                        if ok:
+                            succeeded += 1
+                        elif item_status in [409, 422, 429, 503]:
+                            throttled = True
+                            retry_or_fail(document, error)
+                        else:
+                            failed[document[key_field]] = error
+                if throttled:
+                    self.upload_batch_size = max(
+                        self.min_upload_batch_size, self.upload_batch_size // 2
+                    )
+                    time.sleep(self.upload_backoff * random.uniform(0.5, 1.5))
+                    self.upload_backoff = min(60, self.upload_backoff * 2)
+                else:
+                    self.upload_batch_size = min(
+                        self.max_upload_batch_size, self.upload_batch_size * 2
+                    )
+                    self.upload_backoff = 1
+        if failed:
+            logging.error(f"Indexing of {len(failed)} documents FAILED in {index_name}")
+        return {
+            "succeeded": succeeded,
+            "failed": failed,
+            "batch_size": self.upload_batch_size,
+        }
+
+    def delete_documents(self, index_name, keys, key_field="id"):
+        result = self.upload_documents(
+            index_name,
+            ({key_field: key} for key in keys),
+            key_field=key_field,
+            action="delete",
+        )
+        return not result["failed"]
+
+    def search_document_keys(self, index_name, filter_expression, key_field="id"):
+        """
+        Returns the keys of all documents of the index matching the OData filter.
+        """
+        keys, page_size = [], 1000
+        while True:
+            response = self.transport.post(
+                f"{self.endpoint}/indexes('{index_name}')/docs/search.post.search?api-version={self.api_version}",
+                json={
+                    "search": "*",
+                    "filter": filter_expression,
+                    "select": key_field,
+                    "top": page_size,
+                    "skip": len(keys),
+                },
+            )
+            if response.status_code != 200:
+                logging.error(f"ERROR: {response.status_code}|| {response.text}")
+                return keys
+            page = [document[key_field] for document in response.json()["value"]]
+            keys.extend(page)
+            if len(page) < page_size:
+                return keys
+
+    async def asearch(self, index_name, payload):
+        """
+        Runs a docs/search.post.search query on the asyncio transport.
+        Returns the response JSON, or None if the query failed.
+        """
+        response = await self.transport.apost(
+            f"{self.endpoint}/indexes('{index_name}')/docs/search.post.search?api-version={self.api_version}",
+            json=payload,
+        )
+        if response.status_code != 200:
+            logging.error(f"ERROR: {response.status_code}|| {response.text}")
+            return None
+        return response.json()
@@ -0,0 +1,140 @@
+import hashlib
+import logging
+import re
+import unicodedata
+
+VALIDATOR_FIELDS = ("etag", "last_modified", "content_hash", "blob_name", "text_hash")
+
+
+def content_hash(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+def normalise_text(text):
+    """
+    Normalises extracted text so that whitespace and unicode form changes
+    do not change its fingerprint.
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def text_fingerprint(text):
+    return content_hash(normalise_text(text))
+
+
+def build_validator(response_headers, body, blob_name="", text=None):
+    """
+    Builds the validator record of a crawled page from its response headers,
+    raw body and extracted text.
+    """
+    return {
+        "etag": response_headers.get("ETag", ""),
+        "last_modified": response_headers.get("Last-Modified", ""),
+        "content_hash": content_hash(body),
+        "blob_name": blob_name,
+        "text_hash": text_fingerprint(text) if text is not None else "",
+    }
+
+
+def is_not_modified(status_code, body, validator):
+    """
+    True if the server answered 304, or returned the exact same body as last time.
+    """
+    if not validator or not validator.get("blob_name"):
+        return False
+    if status_code == 304:
+        return True
+    if status_code != 200 or body is None:
+        return False
+    return validator.get("content_hash") == content_hash(body)
+
+
+def is_text_unchanged(text, validator):
+    """
+    True if the extracted text has the same fingerprint as the text already
+    stored in the page's blob from the previous crawl.
+    """
+    if (
+        not validator
+        or not validator.get("blob_name")
+        or not validator.get("text_hash")
+    ):
+        return False
+    return validator["text_hash"] == text_fingerprint(text)
+
+
+def conditional_headers(validator):
+    """
+    Returns the If-None-Match / If-Modified-Since headers for a conditional GET.
+    Only pages that already have a stored blob can be skipped, so no headers are
+    sent for the others.
+    """
+    headers = {}
+    if not validator or not validator.get("blob_name"):
+        return headers
+    if validator.get("etag"):
+        headers["If-None-Match"] = validator["etag"]
+    if validator.get("last_modified"):
+        headers["If-Modified-Since"] = validator["last_modified"]
+    return headers
+
+
+class ValidatorStore:
+    """
+    Persistent URL -> (ETag, Last-Modified, content hash, blob name, text fingerprint)
+    store. Kept as a CSV blob next to the cached sitemap.
+    The text fingerprint is the content manifest used to avoid re-uploading, and so
+    re-indexing, pages whose extracted text did not change.
+    """
+
+    def __init__(self, rows=None):
+        self.validators = {}
+        self.update_rows(rows or [])
+
+    @classmethod
+    def load(cls, blob_helper, container_name, blob_name):
+        rows = blob_helper.read_csv_blob(
+            container_name=container_name, blob_name=blob_name
+        )
+        logging.info(f"Getting cached validators: {blob_name}. Size = {len(rows)}")
+        return cls(rows)
+
+    def save(self, blob_helper, container_name, blob_name):
+        blob_helper.write_csv_blob(
+            container_name=container_name, blob_name=blob_name, data=self.to_rows()
+        )
+
+    def to_rows(self):
+        return [
+            (url, *[validator.get(field, "") for field in VALIDATOR_FIELDS])
+            for url, validator in sorted(self.validators.items())
+        ]
+
+    def get(self, url):
+        return self.validators.get(url)
+
+    def get_blob_name(self, url):
+        validator = self.validators.get(url)
+        return validator.get("blob_name") if validator else None
+
+    def update(self, url, validator):
+        if validator:
+            self.validators[url] = validator
+
+    def update_rows(self, rows):
+        for row in rows:
+            url, values = row[0], list(row[1:])
+            values += [""] * (len(VALIDATOR_FIELDS) - len(values))
+            self.validators[url] = dict(zip(VALIDATOR_FIELDS, values))
+
+    def remove(self, url):
+        self.validators.pop(url, None)
+
+    def __contains__(self, url):
+        return url in self.validators
+
+    def __len__(self):
+        return len(self.validators)
@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from crawl_cache import normalise_text
+
+
+class EmbeddingCache:
+    """
+    On-disk SQLite cache of chunk embeddings.
+    Entries are keyed by model id, dimensions and the hash of the normalised chunk text,
+    and the least recently used entries are evicted above max_entries.
+    """
+
+    def __init__(self, path, max_entries=500000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(model_id, dimensions, text):
+        normalised = normalise_text(text)
+        return hashlib.sha256(
+            f"{model_id}|{dimensions}|{normalised}".encode("utf-8")
+        ).hexdigest()
+
+    def get_many(self, model_id, dimensions, texts):
+        """
+        Returns the cached embedding of each text, or None for misses.
+        """
+        keys = [self.get_key(model_id, dimensions, text) for text in texts]
+        found = {}
+        with self.lock:
+            # Stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self.connection.commit()
+        embeddings = []
+        for key in keys:
+            if key in found:
+                embeddings.append(array("f", found[key]).tolist())
+            else:
+                embeddings.append(None)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return embeddings
+
+    def put_many(self, model_id, dimensions, texts, embeddings):
+        now = time.time()
+        rows = [
+            (
+                self.get_key(model_id, dimensions, text),
+                array("f", embedding).tobytes(),
+                now,
+            )
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)",
+                rows,
+            )
+            self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used entries above max_entries.
+        """
+        with self.lock:
+            (count,) = self.connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()
+            excess = count - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+                self.connection.commit()
+                logging.info(f"Evicted {excess} embeddings from the cache")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()[0]
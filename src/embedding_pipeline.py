@@ -0,0 +1,311 @@
+import base64
+import hashlib
+import logging
+import math
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+HEADING_PATTERN = re.compile(r"^#{1,6} ")
+BLOCK_SEPARATOR = re.compile(r"\n\s*\n")
+SENTENCE_SEPARATOR = re.compile(r"(?<=[.!?])\s+")
+APPROX_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def get_token_counter(encoding_name="cl100k_base"):
+    """
+    Returns a function counting the tokens of a text.
+    Uses tiktoken, falling back to a word based estimate if the encoding cannot be loaded.
+    """
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(encoding_name)
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        logging.warning(f"tiktoken unavailable, estimating token counts. Error: {e}")
+        return lambda text: math.ceil(len(APPROX_TOKEN_PATTERN.findall(text)) * 4 / 3)
+
+
+def split_oversized(text, count_tokens, max_tokens):
+    """
+    Splits a block larger than max_tokens on sentence, then word boundaries.
+    Yields (piece, token_count).
+    """
+    token_count = count_tokens(text)
+    if token_count <= max_tokens:
+        yield text, token_count
+        return
+    current, current_tokens = [], 0
+    for sentence in SENTENCE_SEPARATOR.split(text):
+        units = [sentence]
+        if count_tokens(sentence) > max_tokens:
+            units = sentence.split()
+        for unit in units:
+            unit_tokens = count_tokens(unit)
+            if current and current_tokens + unit_tokens > max_tokens:
+                piece = " ".join(current)
+                yield piece, count_tokens(piece)
+                current, current_tokens = [], 0
+            current.append(unit)
+            current_tokens += unit_tokens
+    if current:
+        piece = " ".join(current)
+        yield piece, count_tokens(piece)
+
+
+def chunk_text(text, count_tokens, max_tokens=512, overlap_tokens=64):
+    """
+    Splits text into chunks of at most max_tokens, on paragraph boundaries where possible.
+    A markdown heading starts a new chunk once the current one is half full, and the
+    trailing paragraphs of a chunk (up to overlap_tokens) are repeated in the next one.
+    """
+    chunks = []
+    current, has_new_content = [], False
+
+    def current_tokens():
+        return sum(tokens for _, tokens in current)
+
+    for block in BLOCK_SEPARATOR.split(text):
+        block = block.strip()
+        if not block:
+            continue
+        for piece, tokens in split_oversized(block, count_tokens, max_tokens):
+            is_heading = bool(HEADING_PATTERN.match(piece))
+            if current and (
+                current_tokens() + tokens > max_tokens
+                or (is_heading and current_tokens() >= max_tokens // 2)
+            ):
+                if has_new_content:
+                    chunks.append(
+                        "\n\n".join(chunk_piece for chunk_piece, _ in current)
+                    )
+                # Carry over the trailing paragraphs as overlap
+                overlap = []
+                for previous in reversed(current):
+                    if sum(t for _, t in overlap) + previous[1] > overlap_tokens:
+                        break
+                    overlap.insert(0, previous)
+                if sum(t for _, t in overlap) + tokens > max_tokens or is_heading:
+                    overlap = []
+                current, has_new_content = overlap, False
+            current.append((piece, tokens))
+            has_new_content = True
+    if current and has_new_content:
+        chunks.append("\n\n".join(chunk_piece for chunk_piece, _ in current))
+    return chunks
+
+
+def get_chunk_id(parent_key, chunk_index):
+    """
+    Returns a deterministic, key-safe document id for a chunk of parent_key.
+    """
+    digest = hashlib.sha1(parent_key.encode("utf-8")).digest()
+    return (
+        f"{base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')}_{chunk_index}"
+    )
+
+
+class EmbeddingClient:
+    """
+    Batched client for an Azure OpenAI embeddings deployment.
+    Requests are sent with bounded concurrency over a pooled session, and retried
+    with jittered exponential backoff on throttling and server errors.
+    """
+
+    def __init__(
+        self,
+        model_uri,
+        model_name,
+        model_api_key,
+        api_version="2023-05-15",
+        batch_size=100,
+        max_concurrency=4,
+        max_retries=6,
+        timeout=60,
+    ):
+        self.url = f"{model_uri.rstrip('/')}/openai/deployments/{model_name}/embeddings?api-version={api_version}"
+        self.model_name = model_name
+        self.headers = {"Content-Type": "application/json", "api-key": model_api_key}
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_concurrency, pool_maxsize=max_concurrency
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def embed_batch(self, texts):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(
+                    self.url,
+                    headers=self.headers,
+                    json={"input": texts},
+                    timeout=self.timeout,
+                )
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"Embedding request FAILED, retrying. Error: {e}")
+                time.sleep(min(60, 2**attempt) * random.uniform(0.5, 1.5))
+                continue
+            if response.status_code == 200:
+                data = sorted(response.json()["data"], key=lambda item: item["index"])
+                return [item["embedding"] for item in data]
+            if response.status_code not in (429, 500, 502, 503, 504) or (
+                attempt == self.max_retries
+            ):
+                # raise_for_status does not raise for unexpected statuses below 400
+                response.raise_for_status()
+                raise requests.HTTPError(
+                    f"Unexpected embedding response status {response.status_code}",
+                    response=response,
+                )
+            retry_after = response.headers.get("Retry-After")
+            delay = (
+                float(retry_after)
+                if retry_after and retry_after.isdigit()
+                else min(60, 2**attempt) * random.uniform(0.5, 1.5)
+            )
+            logging.warning(
+                f"Embedding request throttled ({response.status_code}), retrying in {delay:.1f}s"
+            )
+            time.sleep(delay)
+        raise RuntimeError(f"Embedding request FAILED after {self.max_retries} retries")
+
+    def embed(self, texts):
+        """
+        Returns the embeddings of texts, in order.
+        """
+        batches = [
+            texts[i : i + self.batch_size]
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            results = executor.map(self.embed_batch, batches)
+            return [embedding for batch in results for embedding in batch]
+
+
+class ChunkEmbeddingPipeline:
+    """
+    Client side alternative to the SplitSkill + AzureOpenAIEmbeddingSkill skillset.
+    Chunks documents, embeds the chunks in batches and pushes them into the vector index.
+    """
+
+    def __init__(
+        self,
+        embedding_client,
+        search_indexer,
+        max_tokens=512,
+        overlap_tokens=64,
+        count_tokens=None,
+        embedding_cache=None,
+        dimensions=None,
+    ):
+        self.embedding_client = embedding_client
+        self.search_indexer = search_indexer
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.count_tokens = count_tokens or get_token_counter()
+        self.embedding_cache = embedding_cache
+        self.dimensions = dimensions
+        # Keys of the chunks that failed to upload, with their errors, over all runs
+        self.failed = {}
+
+    def create_chunk_documents(self, documents):
+        """
+        documents: iterable of (parent_key, text)
+        Returns the vector index documents (without embeddings) of all chunks.
+        """
+        chunk_documents = []
+        for parent_key, text in documents:
+            chunks = chunk_text(
+                text,
+                self.count_tokens,
+                max_tokens=self.max_tokens,
+                overlap_tokens=self.overlap_tokens,
+            )
+            chunk_documents.extend(
+                {
+                    "id": get_chunk_id(parent_key, i),
+                    "parent_key": parent_key,
+                    "chunk": chunk,
+                }
+                for i, chunk in enumerate(chunks)
+            )
+        return chunk_documents
+
+    def embed_documents(self, chunk_documents):
+        """
+        Adds embeddings to chunk_documents. Cached embeddings are reused, and each
+        distinct missing chunk text is embedded once.
+        """
+        texts = [document["chunk"] for document in chunk_documents]
+        model_id = self.embedding_client.model_name
+        if self.embedding_cache is not None:
+            embeddings = self.embedding_cache.get_many(model_id, self.dimensions, texts)
+        else:
+            embeddings = [None] * len(texts)
+        missing = list(
+            dict.fromkeys(
+                text for text, embedding in zip(texts, embeddings) if embedding is None
+            )
+        )
+        if missing:
+            new_embeddings = dict(zip(missing, self.embedding_client.embed(missing)))
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many(
+                    model_id, self.dimensions, missing, new_embeddings.values()
+                )
+            embeddings = [
+                embedding if embedding is not None else new_embeddings[text]
+                for text, embedding in zip(texts, embeddings)
+            ]
+        logging.info(
+            f"Embedded {len(missing)} of {len(texts)} chunks, the rest were cached"
+        )
+        for document, embedding in zip(chunk_documents, embeddings):
+            document["embedding"] = embedding
+        return chunk_documents
+
+    def run(self, documents):
+        """
+        Chunks, embeds and uploads documents to the vector index.
+        Chunks left over from a previous, longer version of a document are deleted.
+        Returns the number of chunks uploaded. Chunks that failed to upload are
+        logged and added to failed.
+        """
+        documents = list(documents)
+        chunk_documents = self.embed_documents(self.create_chunk_documents(documents))
+        result = self.search_indexer.upload_documents(
+            self.search_indexer.vector_index_name, chunk_documents
+        )
+        if result["failed"]:
+            logging.error(
+                f"Upload of {len(result['failed'])} chunks FAILED. Errors: {list(result['failed'].values())[:5]}"
+            )
+            self.failed.update(result["failed"])
+        chunk_ids = {document["id"] for document in chunk_documents}
+        for parent_key, _ in documents:
+            stale_ids = [
+                key
+                for key in self.search_indexer.search_document_keys(
+                    self.search_indexer.vector_index_name,
+                    f"parent_key eq '{parent_key.replace(chr(39), chr(39) * 2)}'",
+                )
+                if key not in chunk_ids
+            ]
+            if stale_ids:
+                self.search_indexer.delete_documents(
+                    self.search_indexer.vector_index_name, stale_ids
+                )
+        logging.info(
+            f"Pushed {result['succeeded']} of {len(chunk_documents)} chunks of {len(documents)} documents to the vector index"
+        )
+        return result["succeeded"]
@@ -2,10 +2,21 @@ import logging
 import azure.functions as func
 import datetime
 import azure.durable_functions as df
-from webcrawler import WebCrawler, AzureBlobHelper
-from utils import get_sitemap_urls, compare_task_lists
+from webcrawler import WebCrawler, AsyncWebCrawler, AzureBlobHelper
+from utils import (
+    compare_manifests,
+    get_sitemap_urls,
+    iter_updated_manifest,
+    sort_manifest,
+)
 from aisearch_utils import AISearchIndexer
+from crawl_cache import ValidatorStore
+from embedding_pipeline import ChunkEmbeddingPipeline, EmbeddingClient
+from embedding_cache import EmbeddingCache
+import itertools
+import json
 import os
+import tempfile
 
 app = df.DFApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
@@ -27,8 +38,98 @@ VECTOR_EMBEDDING_URI = os.getenv("VECTOR_EMBEDDING_URI")
 VECTOR_EMBEDDING_API_KEY = os.getenv("VECTOR_EMBEDDING_API_KEY")
 VECTOR_EMBEDDING_ID = os.getenv("VECTOR_EMBEDDING_ID")
 VECTOR_EMBEDDING_DIMENSION = os.getenv("VECTOR_EMBEDDING_DIMENSION")
-RUN_INDEXER = bool(os.getenv("RUN_INDEXER"))
-RESET_INDEXER = bool(os.getenv("RESET_INDEXER"))
+RUN_INDEXER = os.getenv("RUN_INDEXER") == "True"
+RESET_INDEXER = os.getenv("RESET_INDEXER") == "True"
+# "reset" resets the whole indexer when RESET_INDEXER is set, "selective" only
+# reprocesses the documents of changed and removed blobs
+SEARCH_REINDEX_MODE = os.getenv("SEARCH_REINDEX_MODE", "reset")
+# Wait for the indexer run to complete and log its metrics
+SEARCH_INDEXER_WAIT = os.getenv("SEARCH_INDEXER_WAIT", "False") == "True"
+SEARCH_INDEXER_WAIT_TIMEOUT = int(os.getenv("SEARCH_INDEXER_WAIT_TIMEOUT", "540"))
+# "skillset" (SplitSkill + embedding skill in the indexer) or "client"
+VECTOR_CHUNKING_MODE = os.getenv("VECTOR_CHUNKING_MODE", "skillset")
+VECTOR_CHUNK_MAX_TOKENS = int(os.getenv("VECTOR_CHUNK_MAX_TOKENS", "512"))
+VECTOR_CHUNK_OVERLAP_TOKENS = int(os.getenv("VECTOR_CHUNK_OVERLAP_TOKENS", "64"))
+VECTOR_EMBEDDING_BATCH_SIZE = int(os.getenv("VECTOR_EMBEDDING_BATCH_SIZE", "100"))
+VECTOR_EMBEDDING_CONCURRENCY = int(os.getenv("VECTOR_EMBEDDING_CONCURRENCY", "4"))
+VECTOR_EMBEDDING_CACHE_PATH = os.getenv(
+    "VECTOR_EMBEDDING_CACHE_PATH",
+    os.path.join(tempfile.gettempdir(), "embedding_cache.sqlite3"),
+)
+VECTOR_EMBEDDING_CACHE_MAX_ENTRIES = int(
+    os.getenv("VECTOR_EMBEDDING_CACHE_MAX_ENTRIES", "500000")
+)
+# HNSW parameters of the vector index, see benchmarks/hnsw_benchmark.py
+VECTOR_HNSW_M = int(os.getenv("VECTOR_HNSW_M", "4"))
+VECTOR_HNSW_EF_CONSTRUCTION = int(os.getenv("VECTOR_HNSW_EF_CONSTRUCTION", "400"))
+VECTOR_HNSW_EF_SEARCH = int(os.getenv("VECTOR_HNSW_EF_SEARCH", "500"))
+# Vector storage reduction: "Edm.Half" vectors, "scalar" or "binary" compression,
+# unretrievable or unstored vectors. Requires SEARCH_API_VERSION 2024-05-01-Preview+
+VECTOR_FIELD_TYPE = os.getenv("VECTOR_FIELD_TYPE", "Edm.Single")
+VECTOR_COMPRESSION = os.getenv("VECTOR_COMPRESSION") or None
+VECTOR_COMPRESSION_OVERSAMPLING = int(
+    os.getenv("VECTOR_COMPRESSION_OVERSAMPLING", "10")
+)
+VECTOR_RETRIEVABLE = os.getenv("VECTOR_RETRIEVABLE", "True") == "True"
+VECTOR_STORED = os.getenv("VECTOR_STORED", "True") == "True"
+SEARCH_API_VERSION = os.getenv("SEARCH_API_VERSION", "2023-10-01-Preview")
+CRAWL_BATCH_SIZE = int(os.getenv("CRAWL_BATCH_SIZE", "0"))
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "20"))
+CRAWL_CONCURRENCY_PER_HOST = int(os.getenv("CRAWL_CONCURRENCY_PER_HOST", "4"))
+
+MANIFEST_BLOB_NAME = f"{PROJECT_NAME}-sitemap/sitemap.csv.gz"
+LATEST_MANIFEST_BLOB_NAME = f"{PROJECT_NAME}-sitemap/sitemap.latest.csv.gz"
+LEGACY_SITEMAP_BLOB_NAME = f"{PROJECT_NAME}-sitemap/sitemap.csv"
+VALIDATORS_BLOB_NAME = f"{PROJECT_NAME}-sitemap/validators.csv"
+EMBEDDING_CACHE_BLOB_NAME = f"{PROJECT_NAME}-cache/embeddings.sqlite3"
+
+# Clients reused across invocations running on the same worker
+_blob_helper = None
+_crawler = None
+_async_crawler = None
+
+
+def get_blob_helper():
+    global _blob_helper
+    if _blob_helper is None:
+        _blob_helper = AzureBlobHelper(storage_connection_string=STORAGE_CONNECTION)
+    return _blob_helper
+
+
+def get_crawler():
+    global _crawler
+    if _crawler is None:
+        _crawler = WebCrawler()
+    return _crawler
+
+
+def open_cached_manifest(blob_helper, manifest_blob_name, legacy_blob_name):
+    """
+    Returns an iterator over the cached manifest rows, sorted by URL.
+    Falls back to the unsorted sitemap CSV written by earlier versions.
+    """
+    rows = blob_helper.iter_csv_blob(
+        container_name=CONTAINER_NAME, blob_name=manifest_blob_name
+    )
+    first_row = next(rows, None)
+    if first_row is not None:
+        return itertools.chain([first_row], rows)
+    return iter(
+        sort_manifest(
+            blob_helper.read_csv_blob(
+                container_name=CONTAINER_NAME, blob_name=legacy_blob_name
+            )
+        )
+    )
+
+
+def get_async_crawler():
+    global _async_crawler
+    if _async_crawler is None:
+        _async_crawler = AsyncWebCrawler(
+            max_concurrency=CRAWL_CONCURRENCY, max_per_host=CRAWL_CONCURRENCY_PER_HOST
+        )
+    return _async_crawler
 
 
 @app.schedule(
@@ -60,87 +161,369 @@ def web_scraper_orchestrator(context: df.DurableOrchestrationContext) -> list:
     """
     Orchestrator function to crawl the website and index the crawled data.
     Will run every day at 10 AM.
-    Will parallel process the URLs to crawl.
+    Will parallel process the URLs to crawl, in batches of CRAWL_BATCH_SIZE if set.
     Run the indexer after all the URLs have been crawled.
+    All I/O runs in activities, as the orchestrator code is replayed at every yield.
     """
-    logging.info("Python orchestrator function started.")
-    sitemap_blob_name = f"{PROJECT_NAME}-sitemap/sitemap.csv"
-    blob_helper = AzureBlobHelper(storage_connection_string=STORAGE_CONNECTION)
-    cached_task_list = blob_helper.read_csv_blob(
-        container_name=CONTAINER_NAME, blob_name=sitemap_blob_name
+
+    def log(message):
+        if not context.is_replaying:
+            logging.info(message)
+
+    log("Python orchestrator function started.")
+
+    latest_size = yield context.call_activity("fetch_sitemap_activity", URL)
+    log(
+        f"Getting latest list of URLs from sitemap: {URL}/sitemap.xml. Size = {latest_size}"
     )
-    logging.info(
-        f"Getting cached sitemap: {sitemap_blob_name}. Size = {len(cached_task_list)}"
+
+    plan = yield context.call_activity("plan_crawl_activity", SAMPLE_SIZE)
+    task_list = plan["tasks"]
+    log(f"Number of URLs to crawl: {len(task_list)}")
+
+    log(f"Number of URLs to delete: {len(plan['removed'])}")
+    yield context.call_activity(
+        "delete_blobs_activity", [blob_name for _, blob_name in plan["removed"]]
     )
 
-    latest_task_list = get_sitemap_urls(url=URL)
-    logging.info(
-        f"Getting latest list of URLs from sitemap: {URL}/sitemap.xml. Size = {len(latest_task_list)}"
+    log("STARTING crawling of the website.")
+    crawled = ValidatorStore()
+    if CRAWL_BATCH_SIZE > 0:
+        parallel_tasks = [
+            context.call_activity(
+                "web_scraper_batch_activity", task_list[i : i + CRAWL_BATCH_SIZE]
+            )
+            for i in range(0, len(task_list), CRAWL_BATCH_SIZE)
+        ]
+        batch_results = yield context.task_all(parallel_tasks)
+        for batch_result in batch_results:
+            crawled.update_rows(batch_result["validators"])
+    else:
+        parallel_tasks = [
+            context.call_activity("web_scraper_activity", task) for task in task_list
+        ]
+        results = yield context.task_all(parallel_tasks)
+        for result in results:
+            crawled.update(result["url"], result["validator"])
+    blobnames = [validator["blob_name"] for validator in crawled.validators.values()]
+    # Pages whose extracted text changed since the previous crawl
+    previous_validators = {sub_url: validator for sub_url, _, validator in task_list}
+    changed_blobnames = [
+        validator["blob_name"]
+        for sub_url, validator in crawled.validators.items()
+        if not previous_validators.get(sub_url)
+        or previous_validators[sub_url].get("text_hash") != validator.get("text_hash")
+    ]
+
+    # URLs not crawled (failed or beyond SAMPLE_SIZE) keep their cached entry,
+    # so they are picked up again on the next run
+    uncrawled = dict(plan["uncrawled"])
+    uncrawled.update(
+        (sub_url, plan["cached_lastmods"].get(sub_url))
+        for sub_url, _, _ in task_list
+        if sub_url not in crawled
+    )
+    log(f"Number of URLs not crawled: {len(uncrawled)}")
+    yield context.call_activity(
+        "commit_manifest_activity",
+        {
+            "validators": crawled.to_rows(),
+            "removed": [sub_url for sub_url, _ in plan["removed"]],
+            "uncrawled": uncrawled,
+        },
     )
 
-    task_list, to_delete = compare_task_lists(latest_task_list, cached_task_list)
+    log("CRAWLING of the website COMPLETED.")
 
-    logging.info(f"Number of URLs to delete: {len(to_delete)}")
-    for sub_url, lastmod in to_delete:
-        blob_name = blob_helper.get_blob_name(
-            url=URL, sub_url=sub_url, lastmod=lastmod, project_name=PROJECT_NAME
-        )
-        blob_helper.delete_blob(container_name=CONTAINER_NAME, blob_name=blob_name)
-    blob_helper.write_csv_blob(
+    search_creation_result = yield context.call_activity(
+        "search_index_runner",
+        {
+            "blobnames": blobnames,
+            "changed": changed_blobnames,
+            "removed": [blob_name for _, blob_name in plan["removed"]],
+        },
+    )
+
+    log("Python orchestrator function completed.")
+    return blobnames, search_creation_result
+
+
+@app.activity_trigger(input_name="url")
+def fetch_sitemap_activity(url: str) -> int:
+    """
+    Fetches the sitemap of url and stages it as a manifest sorted by URL.
+    Returns the number of URLs in the sitemap.
+    """
+    latest_manifest = sort_manifest(get_sitemap_urls(url=url))
+    get_blob_helper().write_csv_blob(
         container_name=CONTAINER_NAME,
-        blob_name=sitemap_blob_name,
-        data=latest_task_list,
+        blob_name=LATEST_MANIFEST_BLOB_NAME,
+        data=latest_manifest,
     )
+    return len(latest_manifest)
 
-    task_list = task_list[:SAMPLE_SIZE] if SAMPLE_SIZE > 0 else task_list
-    logging.info(f"Number of URLs to crawl: {len(task_list)}")
 
-    logging.info("STARTING crawling of the website.")
-    blobnames, search_creation_result = [], []
-    parallel_tasks = [
-        context.call_activity("web_scraper_activity", task) for task in task_list
+@app.activity_trigger(input_name="samplesize")
+def plan_crawl_activity(samplesize: int) -> dict:
+    """
+    Diffs the staged sitemap against the cached manifest.
+    Returns:
+    tasks: list of (url, blob_name, validator) to crawl, at most samplesize if > 0
+    removed: list of (url, blob_name) no longer in the sitemap
+    uncrawled: URLs left out by samplesize, mapped to their cached lastmod
+    cached_lastmods: cached lastmod of the modified URLs in tasks
+    """
+    blob_helper = get_blob_helper()
+    validators = ValidatorStore.load(
+        blob_helper, container_name=CONTAINER_NAME, blob_name=VALIDATORS_BLOB_NAME
+    )
+    added, removed, modified = compare_manifests(
+        blob_helper.iter_csv_blob(
+            container_name=CONTAINER_NAME, blob_name=LATEST_MANIFEST_BLOB_NAME
+        ),
+        open_cached_manifest(blob_helper, MANIFEST_BLOB_NAME, LEGACY_SITEMAP_BLOB_NAME),
+    )
+    logging.info(
+        f"Sitemap changes: added = {len(added)}, removed = {len(removed)}, modified = {len(modified)}"
+    )
+
+    def existing_blob_name(sub_url, cached_lastmod):
+        return validators.get_blob_name(sub_url) or blob_helper.get_blob_name(
+            url=URL, sub_url=sub_url, lastmod=cached_lastmod, project_name=PROJECT_NAME
+        )
+
+    # Modified pages are replaced in place, new pages get a new blob
+    task_list = [
+        (
+            sub_url,
+            blob_helper.get_blob_name(
+                url=URL, sub_url=sub_url, lastmod=lastmod, project_name=PROJECT_NAME
+            ),
+            validators.get(sub_url),
+        )
+        for sub_url, lastmod in added.items()
+    ] + [
+        (
+            sub_url,
+            existing_blob_name(sub_url, cached_lastmod),
+            validators.get(sub_url),
+        )
+        for sub_url, (_, cached_lastmod) in modified.items()
     ]
-    blobnames = yield context.task_all(parallel_tasks)
+    sampled = task_list[:samplesize] if samplesize > 0 else task_list
+    cached_lastmods = {
+        sub_url: cached_lastmod for sub_url, (_, cached_lastmod) in modified.items()
+    }
+    return {
+        "tasks": sampled,
+        "removed": [
+            (sub_url, existing_blob_name(sub_url, cached_lastmod))
+            for sub_url, cached_lastmod in removed.items()
+        ],
+        "uncrawled": {
+            sub_url: cached_lastmods.get(sub_url)
+            for sub_url, _, _ in task_list[len(sampled) :]
+        },
+        "cached_lastmods": {
+            sub_url: cached_lastmods[sub_url]
+            for sub_url, _, _ in sampled
+            if sub_url in cached_lastmods
+        },
+    }
 
-    logging.info("CRAWLING of the website COMPLETED.")
 
-    search_creation_result = yield context.call_activity(
-        "search_index_runner", blobnames
+@app.activity_trigger(input_name="blobnames")
+def delete_blobs_activity(blobnames: list) -> int:
+    """
+    Deletes the blobs of the pages removed from the sitemap.
+    """
+    return get_blob_helper().delete_blobs(
+        container_name=CONTAINER_NAME, blob_names=blobnames
     )
 
-    logging.info("Python orchestrator function completed.")
-    return blobnames, search_creation_result
+
+@app.activity_trigger(input_name="result")
+def commit_manifest_activity(result: dict) -> int:
+    """
+    Stores the crawl result: the staged sitemap becomes the cached manifest, and the
+    validators of crawled and removed URLs are updated.
+    result: dict of validators (rows of crawled URLs), removed (URLs) and
+    uncrawled (URLs mapped to their cached lastmod, or None)
+    """
+    blob_helper = get_blob_helper()
+    validators = ValidatorStore.load(
+        blob_helper, container_name=CONTAINER_NAME, blob_name=VALIDATORS_BLOB_NAME
+    )
+    for sub_url in result["removed"]:
+        validators.remove(sub_url)
+    validators.update_rows(result["validators"])
+    validators.save(
+        blob_helper, container_name=CONTAINER_NAME, blob_name=VALIDATORS_BLOB_NAME
+    )
+    blob_helper.write_csv_blob(
+        container_name=CONTAINER_NAME,
+        blob_name=MANIFEST_BLOB_NAME,
+        data=iter_updated_manifest(
+            blob_helper.iter_csv_blob(
+                container_name=CONTAINER_NAME, blob_name=LATEST_MANIFEST_BLOB_NAME
+            ),
+            result["uncrawled"],
+        ),
+    )
+    return len(validators)
 
 
 @app.activity_trigger(input_name="task")
-def web_scraper_activity(task: tuple) -> str:
+def web_scraper_activity(task: tuple) -> dict:
     """
     Scrapes the URL and stores the data in Azure Blob Storage.
-    task: tuple of (url, lastmod)
+    task: tuple of (url, blob_name, validator)
+    validator: validator of the previous crawl of the URL, or None
     """
-    url, lastmod = task
+    url, blob_name, validator = task
     logging.info(f"Crawling of URL STARTED. URL={url}")
-    blob_helper = AzureBlobHelper(storage_connection_string=STORAGE_CONNECTION)
-    crawler = WebCrawler()
-    blob_name = blob_helper.get_blob_name(
-        url=URL, sub_url=url, lastmod=lastmod, project_name=PROJECT_NAME
-    )
-    crawler.crawl_and_store(
+    blob_helper = get_blob_helper()
+    crawler = get_crawler()
+    blob_name, validator = crawler.crawl_and_store(
         sub_url=url,
         blob_helper=blob_helper,
         container_name=CONTAINER_NAME,
         blob_name=blob_name,
+        validator=validator,
     )
     logging.info(f"Crawling of URL COMPLETED. URL={url}")
-    return blob_name
+    return {"url": url, "blob_name": blob_name, "validator": validator}
 
 
-@app.activity_trigger(input_name="blobnames")
-def search_index_runner(blobnames: list) -> bool:
+@app.activity_trigger(input_name="tasks")
+async def web_scraper_batch_activity(tasks: list) -> dict:
+    """
+    Scrapes a batch of URLs concurrently and stores the data in Azure Blob Storage.
+    tasks: list of (url, blob_name, validator)
+    Returns the validator rows of the crawled URLs and the list of URLs that failed.
+    """
+    logging.info(f"Crawling of batch STARTED. Size={len(tasks)}")
+    blob_helper = get_blob_helper()
+    validators = ValidatorStore()
+    crawl_tasks = []
+    for url, blob_name, validator in tasks:
+        validators.update(url, validator)
+        crawl_tasks.append((url, blob_name))
+    results = await get_async_crawler().crawl_and_store_many(
+        tasks=crawl_tasks,
+        blob_helper=blob_helper,
+        container_name=CONTAINER_NAME,
+        validators=validators,
+    )
+    crawled_urls = {url for url, _ in results}
+    failed = [url for url, _ in crawl_tasks if url not in crawled_urls]
+    logging.info(
+        f"Crawling of batch COMPLETED. Crawled={len(crawled_urls)}, Failed={len(failed)}"
+    )
+    return {
+        "validators": [row for row in validators.to_rows() if row[0] in crawled_urls],
+        "failed": failed,
+    }
+
+
+def run_embedding_pipeline(search_indexer, blobnames, group_size=50):
+    """
+    Chunks and embeds the given blobs client side, and pushes them to the vector index.
+    Embeddings are cached in a SQLite file kept in blob storage between runs.
+    """
+    blob_helper = get_blob_helper()
+    blob_helper.download_blob_to_file(
+        container_name=CONTAINER_NAME,
+        blob_name=EMBEDDING_CACHE_BLOB_NAME,
+        file_path=VECTOR_EMBEDDING_CACHE_PATH,
+    )
+    embedding_cache = EmbeddingCache(
+        VECTOR_EMBEDDING_CACHE_PATH, max_entries=VECTOR_EMBEDDING_CACHE_MAX_ENTRIES
+    )
+    pipeline = ChunkEmbeddingPipeline(
+        embedding_client=EmbeddingClient(
+            model_uri=VECTOR_EMBEDDING_URI,
+            model_name=VECTOR_EMBEDDING_ID,
+            model_api_key=VECTOR_EMBEDDING_API_KEY,
+            batch_size=VECTOR_EMBEDDING_BATCH_SIZE,
+            max_concurrency=VECTOR_EMBEDDING_CONCURRENCY,
+        ),
+        search_indexer=search_indexer,
+        max_tokens=VECTOR_CHUNK_MAX_TOKENS,
+        overlap_tokens=VECTOR_CHUNK_OVERLAP_TOKENS,
+        embedding_cache=embedding_cache,
+        dimensions=VECTOR_EMBEDDING_DIMENSION,
+    )
+    pushed = 0
+    try:
+        for i in range(0, len(blobnames), group_size):
+            pushed += pipeline.run(
+                (
+                    blob_name,
+                    blob_helper.download_blob_text(
+                        container_name=CONTAINER_NAME, blob_name=blob_name
+                    ),
+                )
+                for blob_name in blobnames[i : i + group_size]
+            )
+    finally:
+        logging.info(
+            f"Embedding cache hits = {embedding_cache.hits}, misses = {embedding_cache.misses}"
+        )
+        embedding_cache.close()
+        blob_helper.upload_file(
+            container_name=CONTAINER_NAME,
+            blob_name=EMBEDDING_CACHE_BLOB_NAME,
+            file_path=VECTOR_EMBEDDING_CACHE_PATH,
+        )
+    if pipeline.failed:
+        raise RuntimeError(
+            f"{len(pipeline.failed)} chunks failed to upload, {pushed} were pushed"
+        )
+    return pushed
+
+
+def reindex_documents(search_indexer, changed, removed):
+    """
+    Selective alternative to an indexer reset.
+    Documents of changed blobs are queued for reprocessing, and the documents and
+    vector chunks of removed blobs are deleted.
+    """
+    blob_helper = get_blob_helper()
+
+    def get_document_keys(blob_names):
+        # The blob indexer keys the keyword index documents by their blob URL
+        return search_indexer.search_document_keys_in(
+            search_indexer.search_index_name,
+            "metadata_storage_path",
+            [
+                blob_helper.get_blob_client(CONTAINER_NAME, blob_name).url
+                for blob_name in blob_names
+            ],
+        )
+
+    reset = search_indexer.reset_documents(get_document_keys(changed))
+    removed_keys = get_document_keys(removed)
+    deleted = search_indexer.delete_documents(
+        search_indexer.search_index_name, removed_keys
+    )
+    # Chunks are parented to the keyword document, or to the blob in client mode
+    deleted &= search_indexer.delete_chunks(
+        removed if VECTOR_CHUNKING_MODE == "client" else removed_keys
+    )
+    logging.info(
+        f"Selective reindex: changed = {len(changed)}, removed = {len(removed)}"
+    )
+    return reset and deleted
+
+
+@app.activity_trigger(input_name="changes")
+def search_index_runner(changes: dict) -> bool:
     """
     Runs the search indexer.
-    indextype: "search" or "vector"
+    changes: dict of blobnames (crawled), changed and removed blob names
     """
+    blobnames = changes["blobnames"]
     logging.info("STARTING indexing of the crawled data.")
     try:
         search_indexer = AISearchIndexer(
@@ -149,8 +532,12 @@ def search_index_runner(blobnames: list) -> bool:
             search_index_name=SEARCH_INDEX_NAME,
             vector_index_name=VECTOR_INDEX_NAME,
             indexer_name=SEARCH_INDEXER_NAME,
-            vector_skillset_name=VECTOR_SKILLSET_NAME,
+            # In client chunking mode the indexer only fills the keyword index
+            vector_skillset_name=(
+                VECTOR_SKILLSET_NAME if VECTOR_CHUNKING_MODE == "skillset" else None
+            ),
             api_key=SEARCH_API_KEY,
+            api_version=SEARCH_API_VERSION,
         )
         # Step 1 - Create the Data Source
         response = search_indexer.create_data_source_blob_storage(
@@ -171,6 +558,14 @@ def search_index_runner(blobnames: list) -> bool:
             model_name=VECTOR_EMBEDDING_ID,
             model_api_key=VECTOR_EMBEDDING_API_KEY,
             embedding_dims=VECTOR_EMBEDDING_DIMENSION,
+            hnsw_m=VECTOR_HNSW_M,
+            hnsw_ef_construction=VECTOR_HNSW_EF_CONSTRUCTION,
+            hnsw_ef_search=VECTOR_HNSW_EF_SEARCH,
+            vector_type=VECTOR_FIELD_TYPE,
+            vector_compression=VECTOR_COMPRESSION,
+            compression_oversampling=VECTOR_COMPRESSION_OVERSAMPLING,
+            vector_retrievable=VECTOR_RETRIEVABLE,
+            vector_stored=VECTOR_STORED,
         )
         logging.info(f"Vector Search Index status = {response}.")
 
@@ -189,10 +584,42 @@ def search_index_runner(blobnames: list) -> bool:
         )
         logging.info(f"Search Indexer status = {response}")
 
-        # Step 6 - Run the indexer, if config is set to True
-        if RUN_INDEXER == "True":
-            response = search_indexer.run_indexer(reset_flag=RESET_INDEXER)
+        # Step 6 - Reprocess only the changed and removed documents
+        if SEARCH_REINDEX_MODE == "selective":
+            response = reindex_documents(
+                search_indexer, changes["changed"], changes["removed"]
+            )
+            logging.info(f"Selective reindex status = {response}")
+            blobnames = changes["changed"]
+            if not RUN_INDEXER:
+                logging.warning(
+                    "RUN_INDEXER is not set: the reset documents are reprocessed on the next scheduled indexer run."
+                )
+
+        # Step 7 - Run the indexer, if config is set to True. In selective mode the
+        # run only reprocesses the documents reset in step 6, never the whole index
+        if RUN_INDEXER:
+            previous_execution = search_indexer.get_last_execution()
+            response = search_indexer.run_indexer(
+                reset_flag=RESET_INDEXER and SEARCH_REINDEX_MODE != "selective"
+            )
             logging.info(f"Search Indexer Run status = {response}")
+            if response and SEARCH_INDEXER_WAIT:
+                metrics = search_indexer.wait_for_indexer(
+                    previous_execution=previous_execution,
+                    timeout=SEARCH_INDEXER_WAIT_TIMEOUT,
+                )
+                logging.info(f"Search Indexer Run metrics = {json.dumps(metrics)}")
+
+        # Step 8 - Chunk, embed and push the crawled pages to the vector index
+        if VECTOR_CHUNKING_MODE == "client":
+            # The chunks of removed pages are parented to their blob name; the
+            # selective reindex of step 6 already deleted them
+            if SEARCH_REINDEX_MODE != "selective" and changes["removed"]:
+                response = search_indexer.delete_chunks(changes["removed"])
+                logging.info(f"Removed pages chunks deletion status = {response}")
+            response = run_embedding_pipeline(search_indexer, blobnames)
+            logging.info(f"Client side chunking pushed {response} chunks")
 
         return True
     except Exception as e:
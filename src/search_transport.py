@@ -0,0 +1,176 @@
+import asyncio
+import email.utils
+import json
+import logging
+import random
+import time
+import aiohttp
+import requests
+
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+class TransportResponse:
+    """
+    Response of an asyncio request, with the body already read.
+    Mirrors the parts of requests.Response used by the callers.
+    """
+
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class SearchTransport:
+    """
+    Shared HTTP transport for the Azure AI Search REST calls.
+    Keeps connections alive in a pool, applies timeouts, and retries throttled (429/503)
+    and failed requests with jittered exponential backoff, honouring Retry-After.
+    Offers both a sync (requests) and an asyncio (aiohttp) interface.
+    """
+
+    def __init__(
+        self,
+        headers=None,
+        pool_size=20,
+        timeout=30,
+        max_retries=5,
+        backoff_base=0.5,
+        backoff_max=30,
+    ):
+        self.headers = headers or {}
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.async_session = None
+
+    def get_retry_delay(self, attempt, headers=None):
+        """
+        Returns the delay before the next attempt, from the Retry-After headers if
+        the service sent them, else jittered exponential backoff.
+        """
+        headers = headers or {}
+        retry_after_ms = headers.get("retry-after-ms") or headers.get(
+            "x-ms-retry-after-ms"
+        )
+        if retry_after_ms:
+            try:
+                return min(self.backoff_max, float(retry_after_ms) / 1000)
+            except ValueError:
+                pass
+        retry_after = headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(self.backoff_max, float(retry_after))
+            except ValueError:
+                pass
+            try:
+                retry_date = email.utils.parsedate_to_datetime(retry_after)
+                return min(
+                    self.backoff_max, max(0, retry_date.timestamp() - time.time())
+                )
+            except (TypeError, ValueError):
+                # Malformed date, fall back to the exponential backoff
+                pass
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        return random.uniform(0, delay)
+
+    def request(self, method, url, max_retries=None, **kwargs):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        headers = {**self.headers, **kwargs.pop("headers", {})}
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(max_retries + 1):
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == max_retries:
+                    raise
+                delay = self.get_retry_delay(attempt)
+                logging.warning(
+                    f"{method} {url} FAILED, retrying in {delay:.1f}s. Error: {e}"
+                )
+                time.sleep(delay)
+                continue
+            if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+                return response
+            delay = self.get_retry_delay(attempt, response.headers)
+            logging.warning(
+                f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s"
+            )
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def get_async_session(self):
+        if self.async_session is None or self.async_session.closed:
+            self.async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.async_session
+
+    async def arequest(self, method, url, max_retries=None, **kwargs):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        headers = {**self.headers, **kwargs.pop("headers", {})}
+        session = self.get_async_session()
+        for attempt in range(max_retries + 1):
+            try:
+                async with session.request(
+                    method, url, headers=headers, **kwargs
+                ) as response:
+                    text = await response.text()
+                    result = TransportResponse(response.status, response.headers, text)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == max_retries:
+                    raise
+                delay = self.get_retry_delay(attempt)
+                logging.warning(
+                    f"{method} {url} FAILED, retrying in {delay:.1f}s. Error: {e}"
+                )
+                await asyncio.sleep(delay)
+                continue
+            if result.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+                return result
+            delay = self.get_retry_delay(attempt, result.headers)
+            logging.warning(
+                f"{method} {url} returned {result.status_code}, retrying in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+
+    async def aget(self, url, **kwargs):
+        return await self.arequest("GET", url, **kwargs)
+
+    async def aput(self, url, **kwargs):
+        return await self.arequest("PUT", url, **kwargs)
+
+    async def apost(self, url, **kwargs):
+        return await self.arequest("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    async def aclose(self):
+        if self.async_session is not None:
+            await self.async_session.close()
@@ -1,25 +1,187 @@
+import logging
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
+
+GZIP_MAGIC = b"\x1f\x8b"
+_SITEMAP_DONE = object()
+
+
+def iter_sitemap_chunks(response, chunk_size=64 * 1024):
+    """
+    Yields the (decompressed) body of a streamed sitemap response in chunks.
+    Content-Encoding is decoded by requests, .xml.gz bodies are detected by their magic bytes.
+    """
+    decompressor = None
+    for i, chunk in enumerate(response.iter_content(chunk_size=chunk_size)):
+        if i == 0 and chunk[:2] == GZIP_MAGIC:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        yield decompressor.decompress(chunk) if decompressor else chunk
+    if decompressor:
+        yield decompressor.flush()
+
+
+def parse_sitemap(session, sitemap_url, timeout=60):
+    """
+    Incrementally parses a single sitemap or sitemap index.
+    Yields ("url", loc, lastmod) for pages and ("sitemap", loc, lastmod) for child sitemaps.
+    Parsed elements are cleared as they are yielded, so memory use is constant.
+    """
+    parser = etree.XMLPullParser(
+        events=("end",), tag=("{*}url", "{*}sitemap"), huge_tree=True
+    )
+    with session.get(sitemap_url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for chunk in iter_sitemap_chunks(response):
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                loc = (element.findtext("{*}loc") or "").strip()
+                lastmod = (element.findtext("{*}lastmod") or "").strip()
+                kind = etree.QName(element).localname
+                # Free the parsed element and its already processed siblings
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+                if loc:
+                    yield kind, loc, lastmod
+        parser.close()
+
+
+def iter_sitemap_urls(sitemap_url, max_workers=4, max_depth=3, session=None):
+    """
+    Generator yielding (loc, lastmod) for every page of sitemap_url.
+    Nested sitemap indexes are followed concurrently, gzip sitemaps are decompressed
+    on the fly. lastmod is "" for pages that do not report one.
+    Raises if any sitemap cannot be read, as a partial list would mark pages stale.
+    """
+    session = session or requests.Session()
+    results = queue.Queue(maxsize=10000)
+    stop = threading.Event()
+    lock = threading.Lock()
+    visited = set()
+    pending = [0]
+    errors = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def crawl(url, depth):
+        try:
+            for kind, loc, lastmod in parse_sitemap(session, url):
+                if stop.is_set():
+                    return
+                if kind == "url":
+                    put((loc, lastmod))
+                elif depth < max_depth:
+                    submit(loc, depth + 1)
+                else:
+                    logging.warning(f"Sitemap {loc} exceeds max depth. Skipping.")
+        except Exception as e:
+            logging.error(f"Reading sitemap {url} FAILED. Error: {e}")
+            errors.append(e)
+        finally:
+            put(_SITEMAP_DONE)
+
+    def submit(url, depth):
+        with lock:
+            if url in visited:
+                return
+            visited.add(url)
+            pending[0] += 1
+        executor.submit(crawl, url, depth)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        submit(sitemap_url, 0)
+        while True:
+            with lock:
+                if pending[0] == 0:
+                    break
+            item = results.get()
+            if errors:
+                raise errors[0]
+            if item is _SITEMAP_DONE:
+                with lock:
+                    pending[0] -= 1
+            else:
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 def get_sitemap_urls(url):
-    sitemap = requests.get(f"{url}/sitemap.xml").text
-    soup = BeautifulSoup(sitemap, "xml")
-    return [
-        (element.find("loc").text, element.find("lastmod").text)
-        for element in soup.find_all("url")
-    ]
+    """
+    Returns an iterator of the (loc, lastmod) entries of the site's sitemap, read
+    as a stream. sort_manifest keeps only one entry per URL when it sorts them.
+    """
+    return iter_sitemap_urls(f"{url}/sitemap.xml")
+
+
+def sort_manifest(rows):
+    """
+    Returns (url, lastmod) manifest rows sorted by URL, keeping the last entry of
+    duplicated URLs.
+    """
+    return sorted(dict((row[0], row[1]) for row in rows).items())
 
 
-def compare_task_lists(latest_task_list, cached_task_list):
+def iter_manifest_diff(latest_manifest, cached_manifest):
     """
-    Compares the latest task list with the cached task list
-    Find the differences and return the list of URLs to add and delete
+    Streaming merge-diff of two manifests of (url, lastmod) rows sorted by URL.
+    Yields (change, url, lastmod, cached_lastmod) where change is one of
+    "added", "removed" or "modified".
     """
-    latest_set = set(latest_task_list)
-    cached_set = set(cached_task_list)
+    latest_iter, cached_iter = iter(latest_manifest), iter(cached_manifest)
+    latest, cached = next(latest_iter, None), next(cached_iter, None)
+    while latest is not None or cached is not None:
+        if cached is None or (latest is not None and latest[0] < cached[0]):
+            yield "added", latest[0], latest[1], None
+            latest = next(latest_iter, None)
+        elif latest is None or cached[0] < latest[0]:
+            yield "removed", cached[0], None, cached[1]
+            cached = next(cached_iter, None)
+        else:
+            if latest[1] != cached[1]:
+                yield "modified", latest[0], latest[1], cached[1]
+            latest, cached = next(latest_iter, None), next(cached_iter, None)
+
 
-    to_add = list(latest_set - cached_set)
-    to_delete = list(cached_set - latest_set)
+def compare_manifests(latest_manifest, cached_manifest):
+    """
+    Compares two manifests sorted by URL.
+    Returns (added, removed, modified) dicts keyed by URL:
+    added and removed map to lastmod, modified maps to (lastmod, cached_lastmod).
+    """
+    added, removed, modified = {}, {}, {}
+    for change, url, lastmod, cached_lastmod in iter_manifest_diff(
+        latest_manifest, cached_manifest
+    ):
+        if change == "added":
+            added[url] = lastmod
+        elif change == "removed":
+            removed[url] = cached_lastmod
+        else:
+            modified[url] = (lastmod, cached_lastmod)
+    return added, removed, modified
 
-    return (to_add, to_delete)
+
+def iter_updated_manifest(latest_manifest, uncrawled):
+    """
+    Yields the rows of the manifest to cache after a crawl.
+    uncrawled maps URLs that were not crawled to their cached lastmod (None for new
+    URLs), so they are picked up again on the next run.
+    """
+    for url, lastmod in latest_manifest:
+        if url not in uncrawled:
+            yield url, lastmod
+        elif uncrawled[url] is not None:
+            yield url, uncrawled[url]
@@ -1,39 +1,110 @@
 import requests
 import logging
+import asyncio
+import aiohttp
 from bs4 import BeautifulSoup
 from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+from concurrent.futures import ThreadPoolExecutor
 import time
 from datetime import datetime
 import html2text
+import lxml.html
+from lxml import etree
 import csv
+import gzip
+import zlib
 from io import StringIO
+from crawl_cache import (
+    build_validator,
+    conditional_headers,
+    is_not_modified,
+    is_text_unchanged,
+)
 
 
 class AzureBlobHelper:
-    def __init__(self, storage_connection_string):
+    # Maximum number of sub-requests in a single blob batch request
+    max_batch_size = 256
+
+    def __init__(self, storage_connection_string, max_workers=8):
         self.blob_service_client = BlobServiceClient.from_connection_string(
             storage_connection_string
         )
+        self.max_workers = max_workers
+        self.known_containers = set()
 
-    def get_blob_client(self, container_name, blob_name):
-        # Check if the container exists
+    def get_container_client(self, container_name):
         container_client = self.blob_service_client.get_container_client(container_name)
-        if not container_client.exists():
-            # Create the container if it does not exist
-            self.blob_service_client.create_container(container_name)
-        return self.blob_service_client.get_blob_client(container_name, blob_name)
+        # Check if the container exists, once per helper instance
+        if container_name not in self.known_containers:
+            if not container_client.exists():
+                # Create the container if it does not exist
+                try:
+                    self.blob_service_client.create_container(container_name)
+                except ResourceExistsError:
+                    pass
+            self.known_containers.add(container_name)
+        return container_client
 
-    def read_csv_blob(self, container_name, blob_name):
+    def get_blob_client(self, container_name, blob_name):
+        return self.get_container_client(container_name).get_blob_client(blob_name)
+
+    def iter_csv_blob(self, container_name, blob_name):
+        """
+        Streams the rows of a CSV blob, gzip compressed if blob_name ends with .gz.
+        Yields nothing if the blob does not exist.
+        """
+        blob_client = self.get_blob_client(container_name, blob_name)
+        try:
+            downloader = blob_client.download_blob()
+        except ResourceNotFoundError:
+            return
+        decompressor = (
+            zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if blob_name.endswith(".gz")
+            else None
+        )
+
+        def iter_lines():
+            pending = b""
+            for chunk in downloader.chunks():
+                pending += decompressor.decompress(chunk) if decompressor else chunk
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    yield line.decode("utf-8") + "\n"
+            if decompressor:
+                pending += decompressor.flush()
+            if pending:
+                yield pending.decode("utf-8")
+
+        for row in csv.reader(iter_lines()):
+            yield tuple(row)
+
+    def download_blob_text(self, container_name, blob_name):
+        blob_client = self.get_blob_client(container_name, blob_name)
+        return blob_client.download_blob().readall().decode("utf-8")
+
+    def download_blob_to_file(self, container_name, blob_name, file_path):
+        """
+        Downloads a blob to file_path. Returns False if the blob does not exist.
+        """
         blob_client = self.get_blob_client(container_name, blob_name)
-        if not blob_client.exists():
-            return []
-        blob_data = blob_client.download_blob().readall()
-        csv_text = blob_data.decode("utf-8")
+        try:
+            downloader = blob_client.download_blob()
+        except ResourceNotFoundError:
+            return False
+        with open(file_path, "wb") as f:
+            downloader.readinto(f)
+        return True
 
-        csv_reader = csv.reader(StringIO(csv_text))
-        rows = [tuple(row) for row in csv_reader]
+    def upload_file(self, container_name, blob_name, file_path):
+        blob_client = self.get_blob_client(container_name, blob_name)
+        with open(file_path, "rb") as f:
+            blob_client.upload_blob(f, overwrite=True)
 
-        return rows
+    def read_csv_blob(self, container_name, blob_name):
+        return list(self.iter_csv_blob(container_name, blob_name))
 
     def write_csv_blob(self, container_name, blob_name, data):
         csv_buffer = StringIO()
@@ -42,12 +113,25 @@ class AzureBlobHelper:
 
         csv_text = csv_buffer.getvalue()
         csv_bytes = csv_text.encode("utf-8")
+        if blob_name.endswith(".gz"):
+            csv_bytes = gzip.compress(csv_bytes)
 
         blob_client = self.get_blob_client(container_name, blob_name)
         blob_client.upload_blob(csv_bytes, overwrite=True)
 
     def get_blob_name(self, url, sub_url, lastmod, project_name="web-scrapper-app"):
-        lastmod_formatted = datetime.strptime(lastmod, "%Y-%m-%d").strftime("%Y%m%d")
+        # lastmod may be a W3C datetime of reduced precision (YYYY, YYYY-MM), or
+        # missing from the sitemap entry
+        lastmod_formatted = "00000000"
+        if lastmod:
+            date_part = lastmod.strip()[:10]
+            date_format = {4: "%Y", 7: "%Y-%m"}.get(len(date_part), "%Y-%m-%d")
+            try:
+                lastmod_formatted = datetime.strptime(date_part, date_format).strftime(
+                    "%Y%m%d"
+                )
+            except ValueError:
+                logging.warning(f"Invalid lastmod {lastmod} for {sub_url}")
         url = "" if url == sub_url else url
         blob_name = f"{project_name}/{sub_url.replace(url, '').replace('/','_')}_{lastmod_formatted}.txt"
         return blob_name
@@ -66,14 +150,102 @@ class AzureBlobHelper:
     def delete_blob(self, container_name, blob_name):
         blob_client = self.get_blob_client(container_name, blob_name)
 
-        if blob_client.exists():
+        try:
             blob_client.delete_blob()
+        except ResourceNotFoundError:
+            pass
         logging.info(f"Deleted blob {blob_name}\n")
 
+    def upload_blobs(self, container_name, blobs):
+        """
+        Uploads many blobs in parallel.
+        blobs: iterable of (blob_name, content)
+        """
+        container_client = self.get_container_client(container_name)
+
+        def upload(blob):
+            blob_name, content = blob
+            container_client.upload_blob(blob_name, content, overwrite=True)
+            return blob_name
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            uploaded = list(executor.map(upload, blobs))
+        logging.info(f"Uploaded {len(uploaded)} blobs to Azure Blob Storage\n")
+        return uploaded
+
+    def delete_blobs(self, container_name, blob_names):
+        """
+        Deletes many blobs using batch delete requests, sent in parallel.
+        Blobs that do not exist are ignored.
+        """
+        container_client = self.get_container_client(container_name)
+        blob_names = list(blob_names)
+        batches = [
+            blob_names[i : i + self.max_batch_size]
+            for i in range(0, len(blob_names), self.max_batch_size)
+        ]
+
+        def delete_batch(batch):
+            responses = container_client.delete_blobs(
+                *batch, raise_on_any_failure=False
+            )
+            failed = [
+                blob_name
+                for blob_name, response in zip(batch, responses)
+                if response.status_code not in (202, 404)
+            ]
+            for blob_name in failed:
+                logging.error(f"Deleting blob {blob_name} FAILED.")
+            return len(batch) - len(failed)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            deleted = sum(executor.map(delete_batch, batches))
+        logging.info(f"Deleted {deleted} blobs in {len(batches)} batches\n")
+        return deleted
+
+
+# Elements whose content is never useful as page text
+DROP_TAGS = {
+    "script",
+    "style",
+    "noscript",
+    "template",
+    "nav",
+    "footer",
+    "svg",
+    "iframe",
+}
+CELL_TAGS = {"td", "th"}
+HEADING_TAGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+BLOCK_TAGS = {
+    "p",
+    "div",
+    "section",
+    "article",
+    "main",
+    "header",
+    "aside",
+    "blockquote",
+    "pre",
+    "ul",
+    "ol",
+    "li",
+    "dl",
+    "dt",
+    "dd",
+    "table",
+    "tr",
+    "br",
+    "hr",
+    "figcaption",
+    "address",
+}
+
 
 class WebCrawler:
     def __init__(self):
         self.wait_time = 10
+        self.html_parser = lxml.html.HTMLParser(remove_comments=True, remove_pis=True)
 
     def parse_html_bs4(self, html):
         soup = BeautifulSoup(html, "html.parser")
@@ -88,8 +260,52 @@ class WebCrawler:
         h.ignore_anchors = True
         return h.handle(html)
 
+    def parse_html_lxml(self, html):
+        """
+        Single pass HTML to text extraction using the C-backed lxml parser.
+        Drops script/style/nav/footer content while walking the tree, and keeps
+        headings (as markdown) and paragraph breaks for chunking.
+        """
+        try:
+            root = lxml.html.document_fromstring(html, parser=self.html_parser)
+        except (etree.ParserError, ValueError):
+            return ""
+
+        blocks, current = [], []
+
+        def flush(prefix=""):
+            text = " ".join("".join(current).split())
+            if text:
+                blocks.append(prefix + text)
+            current.clear()
+
+        walker = etree.iterwalk(root, events=("start", "end"))
+        for event, element in walker:
+            tag = element.tag if isinstance(element.tag, str) else ""
+            if event == "start":
+                if tag in DROP_TAGS:
+                    walker.skip_subtree()
+                    continue
+                if tag in HEADING_TAGS or tag in BLOCK_TAGS:
+                    flush()
+                if element.text:
+                    current.append(element.text)
+            else:
+                if tag in HEADING_TAGS:
+                    flush("#" * HEADING_TAGS[tag] + " ")
+                elif tag in BLOCK_TAGS:
+                    flush()
+                elif tag in CELL_TAGS:
+                    current.append(" ")
+                if element.tail:
+                    current.append(element.tail)
+        flush()
+        return "\n\n".join(blocks)
+
     def parse_html(self, html, parser_lib="bs4"):
-        if parser_lib == "bs4":
+        if parser_lib == "lxml":
+            return self.parse_html_lxml(html)
+        elif parser_lib == "bs4":
             return self.parse_html_bs4(html)
         elif parser_lib == "html2text":
             html_text = self.parse_html_bs4(html)
@@ -98,14 +314,41 @@ class WebCrawler:
             raise ValueError("Parser library not supported.")
 
     def crawl_and_store(
-        self, sub_url, blob_helper, container_name, blob_name, parser_lib="html2text"
+        self,
+        sub_url,
+        blob_helper,
+        container_name,
+        blob_name,
+        parser_lib="lxml",
+        validator=None,
     ):
-        # Send a GET request to the URL
-        response = requests.get(sub_url)
+        """
+        Crawls sub_url and uploads the parsed content to blob_name.
+        If a validator from a previous crawl is given, a conditional GET is sent and
+        parsing and uploading are skipped when the page has not changed.
+        Returns (blob_name, validator), where blob_name is the blob now holding the page.
+        """
+        # Send a (conditional) GET request to the URL
+        response = requests.get(sub_url, headers=conditional_headers(validator))
+
+        if is_not_modified(response.status_code, response.content, validator):
+            logging.info(
+                f"URL={sub_url} NOT MODIFIED. Keeping blob {validator['blob_name']}"
+            )
+            return validator["blob_name"], validator
 
         # Parse the HTML content using specified parser library
         content = self.parse_html(response.content, parser_lib=parser_lib)
 
+        # Keep the existing blob if the extracted text did not change
+        if is_text_unchanged(content, validator):
+            logging.info(
+                f"URL={sub_url} text UNCHANGED. Keeping blob {validator['blob_name']}"
+            )
+            return validator["blob_name"], build_validator(
+                response.headers, response.content, validator["blob_name"], content
+            )
+
         # Upload the content to the blob storage
         blob_helper.upload_blob(container_name, blob_name, content)
 
@@ -115,3 +358,167 @@ class WebCrawler:
             f"Waiting for {self.wait_time} seconds...",
         )
         time.sleep(self.wait_time)
+        return blob_name, build_validator(
+            response.headers, response.content, blob_name, content
+        )
+
+
+class AsyncWebCrawler(WebCrawler):
+    """
+    Crawls many URLs at once over a shared, pooled aiohttp session.
+    In-flight fetches are capped by a semaphore, and per host by the connection
+    pool. Response bodies are streamed with a size limit.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=20,
+        max_per_host=4,
+        max_content_bytes=5 * 1024 * 1024,
+        timeout=30,
+        chunk_size=64 * 1024,
+    ):
+        super().__init__()
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.max_content_bytes = max_content_bytes
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+    def create_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.max_concurrency,
+            limit_per_host=self.max_per_host,
+            ttl_dns_cache=300,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            # Per connect and read, as a total timeout would also count the time
+            # spent waiting for a free connection of the pool
+            timeout=aiohttp.ClientTimeout(
+                total=None, sock_connect=self.timeout, sock_read=self.timeout
+            ),
+        )
+
+    async def fetch(self, session, sub_url, validator=None):
+        """
+        Streams the response body of sub_url, as a conditional GET if a validator is given.
+        Returns (status, headers, body). body is None if the request fails, the page
+        was not modified, or the body exceeds max_content_bytes.
+        """
+        async with session.get(
+            sub_url, headers=conditional_headers(validator)
+        ) as response:
+            if response.status == 304:
+                return response.status, response.headers, None
+            if response.status != 200:
+                logging.warning(f"URL={sub_url} returned HTTP {response.status}")
+                return response.status, response.headers, None
+            if (response.content_length or 0) > self.max_content_bytes:
+                logging.warning(f"URL={sub_url} too large. Skipping.")
+                return response.status, response.headers, None
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                body.extend(chunk)
+                if len(body) > self.max_content_bytes:
+                    logging.warning(f"URL={sub_url} too large. Skipping.")
+                    return response.status, response.headers, None
+            return response.status, response.headers, bytes(body)
+
+    async def fetch_and_parse(
+        self, session, sub_url, parser_lib="lxml", validator=None
+    ):
+        """
+        Returns (url, content, validator).
+        content is None when the page or its extracted text is unchanged (validator
+        keeps the existing blob name) or could not be fetched (validator is None).
+        """
+        try:
+            status, headers, html = await self.fetch(session, sub_url, validator)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"URL={sub_url} scraping FAILED. Error: {e}")
+            return sub_url, None, None
+        if is_not_modified(status, html, validator):
+            return sub_url, None, validator
+        if html is None:
+            return sub_url, None, None
+        # Parsing is CPU bound, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        content = await loop.run_in_executor(None, self.parse_html, html, parser_lib)
+        if is_text_unchanged(content, validator):
+            return (
+                sub_url,
+                None,
+                build_validator(headers, html, validator["blob_name"], content),
+            )
+        return sub_url, content, build_validator(headers, html, text=content)
+
+    async def crawl(self, urls, parser_lib="lxml", session=None, validators=None):
+        """
+        Async generator yielding (url, content, validator) tuples as pages complete.
+        validators is an optional ValidatorStore used for conditional GETs.
+        """
+        own_session = session is None
+        session = session or self.create_session()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def limited_fetch_and_parse(url):
+            async with semaphore:
+                return await self.fetch_and_parse(
+                    session,
+                    url,
+                    parser_lib,
+                    validators.get(url) if validators else None,
+                )
+
+        try:
+            tasks = [
+                asyncio.ensure_future(limited_fetch_and_parse(url)) for url in urls
+            ]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    yield await next_done
+            finally:
+                for task in tasks:
+                    task.cancel()
+        finally:
+            if own_session:
+                await session.close()
+
+    async def crawl_and_store_many(
+        self,
+        tasks,
+        blob_helper,
+        container_name,
+        parser_lib="lxml",
+        validators=None,
+    ):
+        """
+        Crawls every (sub_url, blob_name) in tasks and uploads the parsed content.
+        Unchanged pages keep their existing blob. validators is updated in place.
+        Returns the list of (sub_url, blob_name) now holding each crawled page.
+        """
+        blob_names = dict(tasks)
+        loop = asyncio.get_running_loop()
+        results = []
+        async for sub_url, content, validator in self.crawl(
+            blob_names, parser_lib=parser_lib, validators=validators
+        ):
+            if validator is None:
+                continue
+            if content is None:
+                logging.info(f"URL={sub_url} NOT MODIFIED.")
+                if validators is not None:
+                    validators.update(sub_url, validator)
+                results.append((sub_url, validator["blob_name"]))
+                continue
+            blob_name = blob_names[sub_url]
+            await loop.run_in_executor(
+                None, blob_helper.upload_blob, container_name, blob_name, content
+            )
+            logging.info(f"URL={sub_url} scraping SUCCESS.")
+            validator["blob_name"] = blob_name
+            if validators is not None:
+                validators.update(sub_url, validator)
+            results.append((sub_url, blob_name))
+        return results